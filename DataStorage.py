@@ -1,47 +1,141 @@
-import requests
+import json
 import pandas as pd
 
+# requests is only needed to query Prometheus (not for recorded responses)
+try:
+    import requests
+except ImportError:
+    requests = None
+
+# the GPFS quota metrics of the sponsor reports
+QUOTA_FIELDS = ["gpfs_quota_block_usage_bytes",
+                "gpfs_quota_block_limit_hard_bytes",
+                "gpfs_quota_files_usage",
+                "gpfs_quota_files_limit_hard"]
+
+
+def query_expression(fields):
+    """Return the instant query for all of the series of the fields."""
+    if len(fields) == 1:
+        return f"{fields[0]}" + "{}"
+    return '{__name__=~"' + "|".join(fields) + '"}'
+
+
+def load_response(response):
+    """Return a recorded response (a dictionary or the path to a JSON file)."""
+    if isinstance(response, dict):
+        return response
+    with open(response, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def quota_table(response, fields):
+    """Return a table with one row per owner (uid, or fileset name for GRP and
+       FILESET quotas) and key (fs.filesetname, plus .gid for GRP quotas with a
+       gid) and one column of values per field, made in one pass over the
+       series of the response. Values that a series does not have are NA."""
+    rows = {}
+    owners, fss, filesets, keys = [], [], [], []
+    values = {field: [] for field in fields}
+    single = fields[0] if len(fields) == 1 else None
+    for res in response["data"]["result"]:
+        M = res["metric"]
+        field = M.get("__name__", single)
+        if field not in values:
+            continue
+        if "fs" not in M:
+            print("No fs:", M)
+            continue
+        fs = M["fs"]
+        fsn = M["filesetname"]
+        key = f"{fs}.{fsn}"
+        if "uid" in M:
+            owner = M["uid"]
+        elif M["quota_type"] in ("GRP", "FILESET"):
+            owner = fsn
+            if "gid" in M:
+                key = f"{key}.{M['gid']}"
+        else:
+            print("Neither: ", M)
+            continue
+        row = rows.get((owner, key))
+        if row is None:
+            row = rows[(owner, key)] = len(owners)
+            owners.append(owner)
+            fss.append(fs)
+            filesets.append(fsn)
+            keys.append(key)
+            for column in values.values():
+                column.append(None)
+        assert values[field][row] is None, f"{owner}, {key}, {field}"
+        values[field][row] = int(res["value"][1])
+    table = pd.DataFrame({"owner": pd.Series(owners, dtype="category"),
+                          "fs": pd.Series(fss, dtype="category"),
+                          "filesetname": pd.Series(filesets, dtype="category"),
+                          "key": pd.Series(keys, dtype="category")})
+    for field, column in values.items():
+        table[field] = pd.array(column, dtype="Int64")
+    return table
+
 
 class DataStorage:
-   
+
+    """The values of one GPFS quota metric as a dictionary of owner (uid or
+       fileset name) to a dictionary of key (fs.filesetname) to the value (d).
+       Use DataStorage.fetch to get several metrics with one query. A recorded
+       response (see fetch) is used instead of querying Prometheus."""
+
     PROM_SERVER = "http://vigilant2:8480"
 
-    def __init__(self, field):
+    def __init__(self, field, response=None, table=None):
         self.field = field
-        self.params = {"query": f"{self.field}" + "{}"}
-        self.response = requests.get(f"{self.PROM_SERVER}/api/v1/query", self.params).json()
+        self.params = {"query": query_expression([field])}
+        if table is None:
+            self.response = load_response(response) if response is not None else self.query(self.params)
+            table = quota_table(self.response, [field])
+        self.table = table
         self._build_dict()
 
+    @classmethod
+    def query(cls, params, session=None, timeout=120):
+        getter = session if session is not None else requests
+        return getter.get(f"{cls.PROM_SERVER}/api/v1/query", params, timeout=timeout).json()
+
+    @classmethod
+    def query_range(cls, params, session=None, timeout=300):
+        getter = session if session is not None else requests
+        return getter.get(f"{cls.PROM_SERVER}/api/v1/query_range", params, timeout=timeout).json()
+
+    @classmethod
+    def fetch(cls, fields=QUOTA_FIELDS, response=None, record=None, session=None):
+        """Return a dictionary of field to DataStorage for the fields using one
+           query (or the recorded response) and one quota table. With record
+           the response is written to that file for later offline use."""
+        params = {"query": query_expression(fields)}
+        response = load_response(response) if response is not None else cls.query(params, session)
+        if record:
+            with open(record, "w", encoding="utf-8") as f:
+                json.dump(response, f)
+        table = quota_table(response, fields)
+        return {field: cls(field, table=table) for field in fields}
+
     def _build_dict(self):
         self.d = {}
-        r = self.response["data"]["result"]
-        for res in r:
-            M = res["metric"]
-            if "fs" in M:
-                fs = M["fs"]
-                fsn = M["filesetname"]
-                key = f"{fs}.{fsn}"
-                if "uid" in M:
-                    uid = M["uid"]
-                    if uid in self.d:
-                        assert key not in self.d[uid], f"{self.d[uid]}"
-                        self.d[uid][key] = int(res["value"][1])
-                    else:
-                        self.d[uid] = {key: int(res["value"][1])}
-                elif M["quota_type"] in ("GRP", "FILESET"):
-                    uid = fsn
-                    if "gid" in M:
-                        gid = M["gid"]
-                        key = f"{key}.{gid}"
-                    if uid in self.d:
-                        assert key not in self.d[uid], f"{uid}, {key}, {d[uid]}"
-                        self.d[uid][key] = int(res["value"][1])
-                    else:
-                        self.d[uid] = {key: int(res["value"][1])}
-                else:
-                    print("Neither: ", M)
-            else:
-                print("No fs:", M)
+        values = self.table[self.field]
+        present = values.notna().to_numpy()
+        for owner, key, value in zip(self.table.owner[present], self.table.key[present], values[present]):
+            self.d.setdefault(owner, {})[key] = int(value)
+
+    def fileset_index(self, netid=lambda uid: None):
+        """Return a dictionary of key (fs.filesetname) to the [netid, owner, value]
+           of the owners with that key, where netid(uid) gives the netid of a uid
+           ("UNKNOWN" if None). The owners are in the order of d."""
+        index = {}
+        for owner, values in self.d.items():
+            name = netid(owner) or "UNKNOWN"
+            for key, value in values.items():
+                index.setdefault(key, []).append([name, owner, value])
+        return index
 
 if __name__ == "__main__":
     ds = DataStorage("gpfs_quota_block_usage_bytes")
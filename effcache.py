@@ -0,0 +1,74 @@
+import os
+import time
+import sqlite3
+import pandas as pd
+
+COLUMNS = ["cpu-seconds-used", "cpu-seconds-total", "gpu-seconds-used", "gpu-seconds-total"]
+
+
+class EfficiencyCache:
+
+    """Persistent store of the used and total CPU and GPU seconds of finished
+       jobs keyed by (cluster, jobid). The jobstats in admincomment are only
+       written when a job ends so these numbers never change once computed.
+       Entries older than max_age_days are evicted as are the oldest entries
+       when there are more than max_rows."""
+
+    def __init__(self, path, max_age_days=250, max_rows=20000000):
+        self.path = path
+        self.max_age_days = max_age_days
+        self.max_rows = max_rows
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS efficiency (
+                               cluster TEXT NOT NULL,
+                               jobid TEXT NOT NULL,
+                               cpu_used REAL NOT NULL,
+                               cpu_total REAL NOT NULL,
+                               gpu_used REAL,
+                               gpu_total REAL,
+                               stored INTEGER NOT NULL,
+                               PRIMARY KEY (cluster, jobid))""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS stored_idx ON efficiency (stored)")
+        self.conn.commit()
+
+    def lookup(self, clusters, jobids):
+        """Return a dataframe with the index of jobids and the four usage
+           columns (NaN for jobs that are not in the cache)."""
+        keys = pd.DataFrame({"cluster": clusters.astype(str).values, "jobid": jobids.astype(str).values})
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (cluster TEXT, jobid TEXT)")
+        self.conn.execute("DELETE FROM wanted")
+        self.conn.executemany("INSERT INTO wanted VALUES (?, ?)", keys.itertuples(index=False, name=None))
+        found = pd.read_sql_query("""SELECT e.cluster, e.jobid, e.cpu_used, e.cpu_total, e.gpu_used, e.gpu_total
+                                     FROM wanted w JOIN efficiency e
+                                     ON e.cluster = w.cluster AND e.jobid = w.jobid""", self.conn)
+        self.conn.execute("DELETE FROM wanted")
+        found.columns = ["cluster", "jobid"] + COLUMNS
+        found = found.drop_duplicates(subset=["cluster", "jobid"])
+        usage = keys.merge(found, on=["cluster", "jobid"], how="left")[COLUMNS]
+        usage.index = jobids.index
+        return usage.astype("float64")
+
+    def store(self, clusters, jobids, usage):
+        """Insert or replace the usage (dataframe with the four columns) of the jobs."""
+        now = int(time.time())
+        rows = zip(clusters.astype(str).values,
+                   jobids.astype(str).values,
+                   *[usage[col].astype("float64").where(pd.notnull(usage[col]), None).values for col in COLUMNS],
+                   [now] * usage.shape[0])
+        self.conn.executemany("INSERT OR REPLACE INTO efficiency VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+
+    def evict(self):
+        """Remove old entries and then the oldest entries beyond max_rows."""
+        if self.max_age_days is not None:
+            cutoff = int(time.time()) - self.max_age_days * 24 * 3600
+            self.conn.execute("DELETE FROM efficiency WHERE stored < ?", (cutoff,))
+        if self.max_rows is not None:
+            self.conn.execute("""DELETE FROM efficiency WHERE rowid IN
+                                 (SELECT rowid FROM efficiency ORDER BY stored DESC LIMIT -1 OFFSET ?)""", (self.max_rows,))
+        self.conn.commit()
+
+    def close(self):
+        self.evict()
+        self.conn.close()
@@ -4,15 +4,11 @@ cd /home/jdh4/FROM_TIGER/monthly_sponsor_reports
 
 module purge
 module load anaconda3/2023.3
-python -uB monthly_sponsor_reports.py --report=users --months=1 --basepath=$(pwd)
 
+# the tiger jobs are merged with the local sacct data (the schema is checked
+# and jobs that appear in both are only counted once)
 DT=$(date --date='-1 months' +%Y%m%d)
 OUTFILE=cache_sacct_${DT}_tiger_users.csv
-
-# remove the first line of the tiger file
-sed -i '1d' ${OUTFILE}
-
-cat cache_sacct_${DT}.csv ${OUTFILE} > CACHE.csv
-wc -l cache_sacct_${DT}.csv
 wc -l ${OUTFILE}
-wc -l CACHE.csv
+
+python -uB monthly_sponsor_reports.py --report-type=users --months=1 --basepath=$(pwd) --shard=${OUTFILE}
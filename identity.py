@@ -0,0 +1,160 @@
+import os
+import re
+import csv
+import json
+
+ADDED_UID = re.compile(r"Added user \w+ \(\d+ -")
+
+
+class IdentityIndex:
+
+    """Index of uid<->netid, netid->name and netid->sponsor built from the
+       user changes log, master.uids and the CSV file of users that left the
+       university. The index can be saved to a JSON file. On refresh only the
+       lines appended to the log since the stored byte offset are parsed (the
+       log is parsed again if it was truncated or replaced) while the other
+       files are read again only when they have changed."""
+
+    def __init__(self, path=None, log="tigress_user_changes.log", uids="master.uids",
+                 departed="users_left_university_from_robert_knight.csv"):
+        self.path = path
+        self.sources = {"log":log, "uids":uids, "departed":departed}
+        self.reset()
+        if path and os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("sources") == self.sources:
+                self.__dict__.update({key: state[key] for key in self.state_keys()})
+
+    @staticmethod
+    def state_keys():
+        return ["stamps", "offset", "log_uid2user", "log_user2uid", "names", "sponsors",
+                "uid2user", "user2uid", "departed"]
+
+    def reset(self, source=None):
+        if source in (None, "log"):
+            self.offset = 0
+            self.log_uid2user = {"0":"root"}
+            self.log_user2uid = {"root":"0"}
+            self.names = {}
+            self.sponsors = {}
+        if source in (None, "uids"):
+            self.uid2user = {}
+            self.user2uid = {}
+        if source in (None, "departed"):
+            self.departed = {}
+        if source is None:
+            self.stamps = {}
+
+    def save(self):
+        state = {key: getattr(self, key) for key in self.state_keys()}
+        state["sources"] = self.sources
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def refresh(self):
+        """Bring the index up to date with the source files and return it."""
+        for source, fname in self.sources.items():
+            if not fname or not os.path.isfile(fname):
+                continue
+            st = os.stat(fname)
+            stamp = [st.st_ino, st.st_mtime_ns, st.st_size]
+            old = self.stamps.get(source)
+            if old == stamp:
+                continue
+            if source == "log":
+                # a log that shrank or was replaced is parsed from the start
+                if old is None or old[0] != st.st_ino or st.st_size < self.offset:
+                    self.reset("log")
+                self.read_log(fname)
+            elif source == "uids":
+                self.reset("uids")
+                self.read_uids(fname)
+            else:
+                self.reset("departed")
+                self.read_departed(fname)
+            self.stamps[source] = stamp
+        return self
+
+    def read_log(self, fname):
+        with open(fname, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1  # a partial last line is read on the next refresh
+        text = data[:end].decode("utf-8", errors="replace").replace("\r\n", "\n").replace("\r", "\n")
+        for line in text.split("\n"):
+            self.add_log_line(line)
+        self.offset += end
+
+    def add_log_line(self, line):
+        match = ADDED_UID.findall(line)
+        if match:
+            uid = match[0].split("(")[1].split()[0]
+            netid = match[0].split("(")[0].strip().split()[-1]
+            self.log_uid2user[uid] = netid
+            self.log_user2uid[netid] = uid
+        # a line that was cut short after "Added user" or "Removed user" is skipped
+        if " Added user " in line:
+            words = line.split(" Added user ")[1].split()
+            if not words:
+                return
+            netid = words[0]
+            if f" Added user {netid} (" in line:
+                self.names[netid] = line.split(f" Added user {netid} (")[-1].split(")")[0].split(" - ")[-1]
+            sponsor = line.split(" with sponsor ")[-1].split() if " with sponsor " in line else []
+            if sponsor:
+                self.sponsors[netid] = sponsor[0]
+        if " Removed user " in line:
+            words = line.split(" Removed user ")[1].split()
+            if not words:
+                return
+            netid = words[0]
+            if f" Removed user {netid} (" in line:
+                self.names[netid] = line.split(f" Removed user {netid} (")[-1].split(")")[0]
+            if " sponsor " in line:
+                self.sponsors[netid] = line.split(" sponsor ")[-1].split(";")[0]
+
+    def read_uids(self, fname):
+        with open(fname, "r", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                if len(row) >= 2 and row[0] and row[1] and row[0] != "0":
+                    self.uid2user[row[0]] = row[1]
+                    self.user2uid[row[1]] = row[0]
+
+    def read_departed(self, fname):
+        with open(fname, "r", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                netid = row.get("Netid_")
+                if netid and netid not in self.departed:
+                    self.departed[netid] = [row.get("Sponsor_Netid_") or None, row.get("Name_") or None]
+
+    def netid(self, uid):
+        """Return the netid of uid (master.uids first and then the log)."""
+        return self.uid2user.get(uid) or self.log_uid2user.get(uid)
+
+    def uid(self, netid):
+        """Return the uid of netid (master.uids first and then the log)."""
+        return self.user2uid.get(netid) or self.log_user2uid.get(netid)
+
+    def name(self, netid):
+        return self.names.get(netid)
+
+    def sponsor(self, netid):
+        return self.sponsors.get(netid)
+
+    def departed_user(self, netid):
+        """Return [sponsor, name] of a user that left the university or None."""
+        return self.departed.get(netid)
+
+
+# process-wide indexes (refreshed on each use) for the lookup functions in sponsor.py
+INDEXES = {}
+
+
+def get_index(log="tigress_user_changes.log", uids=None, departed=None):
+    key = (log, uids, departed)
+    if key not in INDEXES:
+        INDEXES[key] = IdentityIndex(log=log, uids=uids, departed=departed)
+    return INDEXES[key].refresh()
@@ -0,0 +1,64 @@
+"""Daily ingestion of finished jobs into the month-partitioned job archive
+   that is read by monthly_sponsor_reports.py --archive. Only jobs that ended
+   since the stored watermark are requested from sacct (see ingest.sh)."""
+
+import os
+import argparse
+from datetime import date
+from datetime import datetime
+import pandas as pd
+
+import jobcache
+from monthly_sponsor_reports import SACCT_FLAGS
+from monthly_sponsor_reports import SACCT_FIELDS
+from monthly_sponsor_reports import SACCT_RENAMINGS
+from monthly_sponsor_reports import SACCT_NUMERIC_FIELDS
+from monthly_sponsor_reports import get_date_range
+from monthly_sponsor_reports import get_cluster_names
+from monthly_sponsor_reports import sacct_shards
+from monthly_sponsor_reports import fetch_sacct_shards
+
+# jobs in these states have finished and will not change
+END_STATES = "BF,CA,CD,DL,F,NF,OOM,PR,TO"
+
+
+def ingest(archive, today, backfill_months=7, workers=4):
+    """Append the jobs that ended since the watermark to the archive. Without
+       a watermark the archive is filled for the past backfill_months."""
+    now = datetime.now()
+    watermark = jobcache.read_watermark(archive)
+    if watermark is None:
+        first, _ = get_date_range(today, backfill_months, report_type="sponsors")
+    else:
+        first = watermark.date()
+    # whole days are requested so up to a day is fetched twice (duplicates are dropped)
+    flags = f"{SACCT_FLAGS} -s {END_STATES}"
+    shards = sacct_shards(flags, first, today, get_cluster_names(), period="week")
+    jobs = fetch_sacct_shards(shards, f"{SACCT_FIELDS},end", SACCT_RENAMINGS, SACCT_NUMERIC_FIELDS, workers)
+    jobs["end"] = pd.to_numeric(jobs["end"], errors="coerce")
+    before = jobs.shape[0]
+    jobs = jobs[pd.notnull(jobs["end"])].astype({"end": "int64"})
+    if (jobs.shape[0] != before): print(f"W: {before - jobs.shape[0]} rows dropped because end was not numeric")
+    months = jobcache.append_to_archive(archive, jobs) if not jobs.empty else []
+    # the watermark is only advanced after all of the partitions are written
+    jobcache.write_watermark(archive, now)
+    return jobs.shape[0], months
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Incremental ingestion of finished jobs for the monthly reports')
+    parser.add_argument('--basepath', required=True, type=str, metavar='PATH',
+                        help='Specify the path to monthly_sponsor_reports.py')
+    parser.add_argument('--backfill-months', type=int, default=7, metavar='N', choices=range(1, 13),
+                        help='Months to fetch when the archive is empty (default: 7)')
+    parser.add_argument('--workers', type=int, default=4, metavar='N',
+                        help='Number of concurrent sacct calls (default: 4)')
+    args = parser.parse_args()
+
+    # convert Slurm timestamps to seconds
+    os.environ["SLURM_TIME_FORMAT"] = "%s"
+
+    archive = f"{args.basepath}/jobs"
+    jobs, months = ingest(archive, date.today(), args.backfill_months, args.workers)
+    print(f"Ingested {jobs} jobs into {archive} ({','.join(months) if months else 'no partitions changed'}).")
@@ -0,0 +1,6 @@
+#!/bin/bash
+PY3=/usr/licensed/anaconda3/2023.3/bin
+MTH=/home/jdh4/bin/monthly_sponsor_reports
+SECS=$(date +%s)
+${PY3}/python -uB ${MTH}/ingest.py \
+                         --basepath=${MTH} > ${MTH}/archive/ingest.log.${SECS} 2>&1
@@ -0,0 +1,208 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+from datetime import timedelta
+import pandas as pd
+
+# feather stores typed columns and allows reading a subset of the columns.
+# fall back to pickle (typed but all columns are read) without pyarrow.
+try:
+    import pyarrow
+    FORMAT = "feather"
+except ImportError:
+    FORMAT = "pickle"
+
+MANIFEST = "manifest.json"
+# entries older than this are removed when a new entry is written
+MAX_AGE_DAYS = 90
+
+
+def write_frame(df, path):
+    """Write a dataframe atomically in the columnar format."""
+    tmp = f"{path}.tmp"
+    if FORMAT == "feather":
+        df.reset_index(drop=True).to_feather(tmp)
+    else:
+        df.reset_index(drop=True).to_pickle(tmp)
+    os.replace(tmp, path)
+
+
+def read_frame(path, columns=None):
+    """Read a dataframe written by write_frame, optionally only some columns."""
+    if path.endswith(".feather"):
+        return pd.read_feather(path, columns=columns)
+    df = pd.read_pickle(path)
+    return df[columns] if columns else df
+
+
+def cache_params(start_date, end_date, clusters, flags, fields, renamings={}, numeric_fields=[]):
+    """Return the parameters that determine the contents of a sacct pull."""
+    return {"start": start_date.isoformat(),
+            "end": end_date.isoformat(),
+            "clusters": sorted(clusters) if clusters else ["ALL"],
+            "flags": " ".join(sorted(flags.split())),
+            "fields": fields,
+            "renamings": dict(sorted(dict(renamings).items())),
+            "numeric_fields": list(numeric_fields)}
+
+
+def cache_key(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def load_manifest(cachedir):
+    fname = os.path.join(cachedir, MANIFEST)
+    if not os.path.isfile(fname):
+        return {}
+    with open(fname, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(cachedir, manifest):
+    fname = os.path.join(cachedir, MANIFEST)
+    with open(f"{fname}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f"{fname}.tmp", fname)
+
+
+def read_cache(cachedir, params, columns=None, max_age_days=None, verbose=True):
+    """Return the cached dataframe for params (only columns if given) or None
+       if there is no valid entry. An entry is rejected if its parameters or
+       columns do not match, if it was written before the end of the reporting
+       period (some jobs had not finished) or if it is older than max_age_days."""
+    key = cache_key(params)
+    entry = load_manifest(cachedir).get(key)
+    if entry is None:
+        return None
+    fname = os.path.join(cachedir, entry["file"])
+    created = datetime.fromisoformat(entry["created"])
+    end_of_period = datetime.fromisoformat(params["end"]) + timedelta(days=1)
+    reason = None
+    if entry["params"] != params:
+        reason = "parameters do not match"
+    elif not os.path.isfile(fname):
+        reason = f"{fname} is missing"
+    elif created < end_of_period:
+        reason = "written before the end of the reporting period"
+    elif max_age_days is not None and datetime.now() - created > timedelta(days=max_age_days):
+        reason = f"older than {max_age_days} days"
+    elif columns and not set(columns).issubset(entry["columns"]):
+        reason = "missing columns"
+    if reason:
+        if verbose: print(f"W: Ignoring cache entry {key} ({reason}).")
+        return None
+    return read_frame(fname, columns)
+
+
+def prune_manifest(cachedir, manifest, key, params, max_age_days):
+    """Remove the entries (and their files) that were superseded by the entry
+       for key (same period with other parameters) or that are older than
+       max_age_days, as well as files that are not in the manifest."""
+    cutoff = datetime.now() - timedelta(days=max_age_days) if max_age_days is not None else None
+    for other, entry in list(manifest.items()):
+        if other == key:
+            continue
+        same_period = (entry["params"]["start"], entry["params"]["end"]) == (params["start"], params["end"])
+        if same_period or (cutoff and datetime.fromisoformat(entry["created"]) < cutoff):
+            del manifest[other]
+    kept = {entry["file"] for entry in manifest.values()}
+    for fname in os.listdir(cachedir):
+        if fname.startswith("sacct_") and fname not in kept:
+            os.remove(os.path.join(cachedir, fname))
+
+
+def write_cache(cachedir, params, df, max_age_days=MAX_AGE_DAYS):
+    """Store df and record it in the manifest (replacing any entry for params).
+       Superseded and old entries are pruned (see prune_manifest)."""
+    os.makedirs(cachedir, exist_ok=True)
+    key = cache_key(params)
+    fname = f"sacct_{params['start']}_{params['end']}_{key}.{FORMAT}"
+    write_frame(df, os.path.join(cachedir, fname))
+    manifest = load_manifest(cachedir)
+    manifest[key] = {"file": fname,
+                     "params": params,
+                     "created": datetime.now().isoformat(timespec="seconds"),
+                     "rows": int(df.shape[0]),
+                     "columns": list(df.columns)}
+    prune_manifest(cachedir, manifest, key, params, max_age_days)
+    save_manifest(cachedir, manifest)
+    return fname
+
+
+#################
+## JOB ARCHIVE ##
+#################
+# Finished jobs never change so they are stored once in files partitioned
+# by the month in which the job ended (jobs/YYYY-MM.feather). The watermark
+# is the time of the last successful ingestion (see ingest.py).
+
+WATERMARK = "watermark"
+
+
+def read_watermark(archive):
+    """Return the datetime of the last ingestion or None if there is no archive."""
+    fname = os.path.join(archive, WATERMARK)
+    if not os.path.isfile(fname):
+        return None
+    with open(fname, "r", encoding="utf-8") as f:
+        return datetime.fromisoformat(f.read().strip())
+
+
+def write_watermark(archive, watermark):
+    fname = os.path.join(archive, WATERMARK)
+    with open(f"{fname}.tmp", "w", encoding="utf-8") as f:
+        f.write(watermark.isoformat(timespec="seconds") + "\n")
+    os.replace(f"{fname}.tmp", fname)
+
+
+def partition_path(archive, month):
+    return os.path.join(archive, f"{month}.{FORMAT}")
+
+
+def months_between(first, last):
+    """Return the YYYY-MM strings from the month of first to the month of last."""
+    months = []
+    year, month = first.year, first.month
+    while (year, month) <= (last.year, last.month):
+        months.append(f"{year}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def append_to_archive(archive, jobs):
+    """Add finished jobs (with a numeric end column) to the monthly partitions.
+       Jobs already in the archive are replaced (dedup on cluster and jobid)."""
+    os.makedirs(archive, exist_ok=True)
+    months = pd.to_datetime(jobs["end"], unit="s").dt.strftime("%Y-%m")
+    for month, new in jobs.groupby(months):
+        fname = partition_path(archive, month)
+        if os.path.isfile(fname):
+            new = pd.concat([read_frame(fname), new], ignore_index=True)
+        new = new.drop_duplicates(subset=["cluster", "jobid"], keep="last", ignore_index=True)
+        write_frame(new, fname)
+    return sorted(months.unique())
+
+
+def read_archive(archive, start_date, end_date, columns=None):
+    """Return the archived jobs that ran during the period (the same selection
+       as sacct -S start_date -E end_date for finished jobs). The end column is
+       dropped so that the result has the same columns as the sacct data (or
+       only columns if given)."""
+    start_ts = datetime.combine(start_date, datetime.min.time()).timestamp()
+    end_ts = datetime.combine(end_date, datetime.max.time()).timestamp()
+    # jobs that ran during the period may have ended at any time up to the watermark
+    last = max(end_date, (read_watermark(archive) or datetime.min).date())
+    wanted = list(dict.fromkeys(list(columns) + ["start", "end"])) if columns else None
+    frames = []
+    for month in months_between(start_date - timedelta(days=1), last + timedelta(days=1)):
+        fname = partition_path(archive, month)
+        if os.path.isfile(fname):
+            frames.append(read_frame(fname, wanted))
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    jobs = pd.concat(frames, ignore_index=True)
+    start = pd.to_numeric(jobs["start"], errors="coerce")
+    jobs = jobs[(jobs["end"] >= start_ts) & ~(start > end_ts)]
+    jobs = jobs[columns] if columns else jobs.drop(columns=["end"])
+    return jobs.reset_index(drop=True)
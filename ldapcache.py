@@ -0,0 +1,116 @@
+import os
+import time
+import json
+import sqlite3
+from sponsor import strip_accents
+from sponsor import get_full_name_from_ldap
+from sponsor import get_sponsor_netid_per_cluster_dicts_from_ldap
+from sponsor import run_ldap_lookups
+
+SECONDS_PER_DAY = 86400
+# netids per SELECT (below the default limit of 999 parameters of older SQLite)
+CHUNK_SIZE = 500
+
+
+class LdapCache:
+
+    """Persistent cache of LDAP lookups (sponsor dictionaries and full names)
+       keyed by (kind, netid). Entries for netids that were not found are kept
+       for negative_ttl_days and the others for ttl_days. With refresh=True all
+       lookups go to LDAP (and the cache is updated) while with offline=True
+       LDAP is never called and misses are returned as not found."""
+
+    def __init__(self, path, ttl_days=30, negative_ttl_days=3, refresh=False, offline=False):
+        self.ttl = ttl_days * SECONDS_PER_DAY
+        self.negative_ttl = negative_ttl_days * SECONDS_PER_DAY
+        self.refresh = refresh
+        self.offline = offline
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS lookups (
+                               kind TEXT NOT NULL,
+                               netid TEXT NOT NULL,
+                               value TEXT,
+                               found INTEGER NOT NULL,
+                               stored INTEGER NOT NULL,
+                               PRIMARY KEY (kind, netid))""")
+        self.conn.commit()
+
+    def get(self, kind, netids):
+        """Return a dictionary of netid to value for the netids with an entry
+           that has not expired (nothing when refresh is set)."""
+        if self.refresh:
+            return {}
+        now = int(time.time())
+        netids = list(netids)
+        found = {}
+        for i in range(0, len(netids), CHUNK_SIZE):
+            chunk = netids[i:i + CHUNK_SIZE]
+            query = f"""SELECT netid, value, found, stored FROM lookups
+                        WHERE kind = ? AND netid IN ({",".join("?" * len(chunk))})"""
+            for netid, value, ok, stored in self.conn.execute(query, [kind] + chunk):
+                ttl = self.ttl if ok else self.negative_ttl
+                if self.offline or now - stored < ttl:
+                    found[netid] = json.loads(value)
+        return found
+
+    def put(self, kind, values, found):
+        """Store the values (dictionary of netid to value) where found(value)
+           is False for netids that are not in LDAP."""
+        now = int(time.time())
+        rows = [(kind, netid, json.dumps(value), int(bool(found(value))), now) for netid, value in values.items()]
+        self.conn.executemany("INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+UNKNOWN_SPONSOR = {"della":None, "stellar":None, "tiger":None, "tigressdata":None, "traverse":None, "displayname":None}
+
+
+def sponsor_found(sponsor):
+    return any(value is not None for value in sponsor.values())
+
+
+def get_sponsor_dicts(cache, netids, verbose=True, workers=4):
+    """Return a dictionary of netid to the sponsor dictionary (see
+       get_sponsor_netid_per_cluster_dict_from_ldap) using the cache and a
+       batched LDAP query for the misses. Users whose lookup failed (or that
+       are not in the cache in offline mode) get an empty sponsor dictionary
+       which is not cached."""
+    netids = list(dict.fromkeys(netids))
+    sponsors = cache.get("sponsor", set(netids))
+    missing = [netid for netid in netids if netid not in sponsors]
+    if missing and cache.offline:
+        if verbose: print(f"W: Offline mode. {len(missing)} users not found in the LDAP cache.")
+    elif missing:
+        resolved = get_sponsor_netid_per_cluster_dicts_from_ldap(missing, verbose=verbose, workers=workers)
+        cache.put("sponsor", resolved, sponsor_found)
+        sponsors.update(resolved)
+    return {netid: sponsors.get(netid, dict(UNKNOWN_SPONSOR)) for netid in netids}
+
+
+def get_full_names(cache, netids, known=None, verbose=True, workers=8):
+    """Return a dictionary of netid to full name (see get_full_name_from_ldap).
+       Names in known (e.g., the displayname of the sponsor dictionaries of
+       this run) are used first, then the cache and the remaining names are
+       looked up concurrently. Failed lookups are None and not cached."""
+    netids = list(dict.fromkeys(netids))
+    known = known or {}
+    names = {netid: strip_accents(known[netid]) for netid in netids if known.get(netid)}
+    names.update(cache.get("name", {netid for netid in netids if netid not in names}))
+    missing = [netid for netid in netids if netid not in names]
+    if missing and cache.offline:
+        if verbose: print(f"W: Offline mode. {len(missing)} names not found in the LDAP cache.")
+    elif missing:
+        resolved, _ = run_ldap_lookups(lambda netid: get_full_name_from_ldap(netid, verbose=verbose), missing,
+                                       workers=workers, verbose=verbose)
+        cache.put("name", resolved, lambda name: name is not None)
+        names.update(resolved)
+    return {netid: names.get(netid) for netid in netids}
+
+
+def get_full_name(cache, netid, known=None, verbose=True):
+    """Return the full name of netid (see get_full_names)."""
+    return get_full_names(cache, [netid], known, verbose=verbose, workers=1)[netid]
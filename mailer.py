@@ -0,0 +1,98 @@
+import time
+import queue
+import smtplib
+import threading
+
+# errors after which the message is sent again on a new connection
+TRANSIENT_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError)
+
+
+def is_transient(error):
+    """Return True if sending again may succeed (connection errors and 4xx replies)."""
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+class Mailer:
+
+    """Sends emails over a pool of at most connections persistent SMTP
+       connections (opened when first needed) instead of one connection per
+       email. A connection that fails is closed and opened again. Emails that
+       fail with a transient error are retried up to retries times after
+       waiting backoff, 2 * backoff, ... seconds while other errors (e.g., a
+       refused recipient) are raised. At most rate emails per second are sent
+       over all of the connections (no limit if rate is None). send() can be
+       called from several threads."""
+
+    def __init__(self, host="localhost", port=0, connections=1, rate=None, retries=3, backoff=1.0,
+                 factory=smtplib.SMTP):
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.factory = factory
+        self.pool = queue.Queue()
+        for _ in range(max(1, connections)):
+            self.pool.put(None)
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+        self.sent = 0
+        self.reconnects = 0
+
+    def throttle(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + 1.0 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def connect(self):
+        return self.factory(self.host, self.port)
+
+    @staticmethod
+    def disconnect(conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+    def send(self, sender, addressee, message):
+        """Send the message (a string with the headers) from sender to addressee."""
+        conn = self.pool.get()
+        try:
+            for i in range(self.retries + 1):
+                try:
+                    if conn is None:
+                        conn = self.connect()
+                    self.throttle()
+                    conn.sendmail(sender, addressee, message)
+                    with self.lock:
+                        self.sent += 1
+                    return
+                except (smtplib.SMTPException, OSError) as error:
+                    if not is_transient(error) or i == self.retries:
+                        raise
+                    if conn is not None:
+                        self.disconnect(conn)
+                        conn = None
+                        with self.lock:
+                            self.reconnects += 1
+                    time.sleep(self.backoff * 2**i)
+        finally:
+            self.pool.put(conn)
+
+    def close(self):
+        """Close the open connections."""
+        while not self.pool.empty():
+            conn = self.pool.get()
+            if conn is not None:
+                self.disconnect(conn)
@@ -3,18 +3,33 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 
 import os
 import sys
-import math
+import csv
 import argparse
 import subprocess
 import textwrap
+import threading
+import multiprocessing
+import queue
+import time
 import calendar
 from datetime import date
 from datetime import datetime
+from datetime import timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 from random import random
 import numpy as np
 import pandas as pd
 
-from sponsor import get_full_name_from_ldap
+import jobcache
+import effcache
+import ldapcache
+import identity
+import render
+import spool
+import mailer
+from render import add_heading
 from sponsor import get_sponsor_netid_per_cluster_dict_from_ldap
 
 from efficiency import get_stats_dict  # wget https://raw.githubusercontent.com/jdh4/job_defense_shield/main/efficiency.py
@@ -52,6 +67,14 @@ SECONDS_PER_MINUTE = 60
 SECONDS_PER_HOUR = 3600
 HOURS_PER_DAY = 24
 
+# sacct query for the reports (also used by ingest.py for the job archive)
+SACCT_FLAGS = "-L -a -X -P -n"
+SACCT_FIELDS = "jobid,user,cluster,account,partition,cputimeraw,elapsedraw,timelimitraw,nnodes,ncpus,alloctres,submit,eligible,start,admincomment"
+SACCT_RENAMINGS = {"user":"netid", "cputimeraw":"cpu-seconds", "nnodes":"nodes", "ncpus":"cores", "timelimitraw":"limit-minutes"}
+SACCT_NUMERIC_FIELDS = ["cpu-seconds", "elapsedraw", "limit-minutes", "nodes", "cores", "submit", "eligible"]
+# the columns used by the reports (the cache and the archive keep all of the fields)
+SACCT_REPORT_COLUMNS = ["jobid", "netid", "cluster", "account", "partition", "cpu-seconds", "elapsedraw", "alloctres", "start", "admincomment"]
+
 def get_date_range(today, N, report_type="sponsors"):
   #return date(2023, 3, 15), date(2023, 5, 14)
   #return date(2023, 6, 1), date(2023, 8, 30)
@@ -77,7 +100,7 @@ def get_date_range(today, N, report_type="sponsors"):
     sys.exit("Error: get_date_range(): report_type does not match choices.")
   return start_date, end_date
 
-def send_email(s, addressee, start_date, end_date, sender="cses@princeton.edu"):
+def email_message(s, addressee, start_date, end_date, sender="cses@princeton.edu"):
   msg = MIMEMultipart('alternative')
   msg['Subject'] = f"Slurm Accounting Report ({start_date.strftime('%b %-d, %Y')} - {end_date.strftime('%b %-d, %Y')})"
   msg['From'] = sender
@@ -86,29 +109,165 @@ def send_email(s, addressee, start_date, end_date, sender="cses@princeton.edu"):
   html = f'<html><head></head><body><font face="Courier New, Courier, monospace"><pre>{s}</pre></font></body></html>'
   part1 = MIMEText(text, 'plain'); msg.attach(part1) 
   part2 = MIMEText(html, 'html');  msg.attach(part2)
+  return msg.as_string()
+
+def send_email(s, addressee, start_date, end_date, sender="cses@princeton.edu", smtp=None):
+  # with smtp (a mailer.Mailer) the email goes over its persistent connections
+  message = email_message(s, addressee, start_date, end_date, sender)
+  if smtp is not None:
+    smtp.send(sender, addressee, message)
+    return None
   s = smtplib.SMTP('localhost')
-  s.sendmail(sender, addressee, msg.as_string())
+  s.sendmail(sender, addressee, message)
   s.quit()
   return None
 
-def raw_dataframe_from_sacct(flags, start_date, end_date, fields, basepath, renamings=[], numeric_fields=[], email=False, use_cache=False):
-  fname = f"{basepath}/cache_sacct_{start_date.strftime('%Y%m%d')}.csv"
-  if not email and use_cache and os.path.exists(fname):
-    print("Reading cache file ... ", end="", flush=True)
-    rw = pd.read_csv(fname, low_memory=False)
-    print("done.", flush=True)
+def parse_sacct_stream(stream, fields, renamings={}, numeric_fields=[], chunksize=200000):
+  # parse pipe-delimited sacct output chunk by chunk so that parsing overlaps
+  # with sacct still writing and only the typed columns are kept in memory
+  names = [dict(renamings).get(field, field) for field in fields.split(",")]
+  dtypes = {name:str for name in names if name not in numeric_fields}
+  reader = pd.read_csv(stream, sep="|", header=None, names=names, dtype=dtypes, quoting=csv.QUOTE_NONE,
+                       na_filter=False, engine="c", chunksize=chunksize)
+  # the numeric fields of each chunk are converted right away (empty or malformed values as
+  # before) and the chunks are joined one column at a time so that the peak memory stays near
+  # the size of the final table
+  pieces = {name:[] for name in names}
+  for chunk in reader:
+    for field in numeric_fields:
+      if not pd.api.types.is_numeric_dtype(chunk[field]): chunk[field] = pd.to_numeric(chunk[field])
+    for name in names:
+      pieces[name].append(chunk.pop(name))
+    del chunk
+  if not pieces[names[0]]: return pd.DataFrame(columns=names)
+  rw = pd.DataFrame(index=pd.RangeIndex(sum(len(piece) for piece in pieces[names[0]])))
+  for name in names:
+    rw[name] = pd.concat(pieces.pop(name), ignore_index=True)
+  return rw
+
+def stream_sacct(flags, start_date, end_date, fields, renamings=[], numeric_fields=[], timeout=300):
+  cmd = f"sacct {flags} -S {start_date.strftime('%Y-%m-%d')}T00:00:00 -E {end_date.strftime('%Y-%m-%d')}T23:59:59 -o {fields}"
+  proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True, text=True)
+  timer = threading.Timer(timeout, proc.kill)
+  timer.start()
+  try:
+    rw = parse_sacct_stream(proc.stdout, fields, renamings, numeric_fields)
+  finally:
+    proc.stdout.close()
+    returncode = proc.wait()
+    timer.cancel()
+  if returncode != 0: raise subprocess.CalledProcessError(returncode, cmd)
+  return rw
+
+def get_cluster_names():
+  # same set of clusters that sacct -L covers (empty list if sacctmgr is unavailable)
+  cmd = "sacctmgr -n -P list clusters format=cluster"
+  try:
+    output = subprocess.run(cmd, stdout=subprocess.PIPE, shell=True, timeout=30, text=True, check=True)
+  except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+    return []
+  return sorted(set(line.strip() for line in output.stdout.split("\n") if line.strip()))
+
+def time_slices(start_date, end_date, period="month"):
+  # split the reporting period into consecutive (first, last) days by week or calendar month
+  slices = []
+  first = start_date
+  while first <= end_date:
+    if period == "week":
+      last = first + timedelta(days=6)
+    elif period == "month":
+      _, last_day_of_month = calendar.monthrange(first.year, first.month)
+      last = date(first.year, first.month, last_day_of_month)
+    else:
+      sys.exit("Error: time_slices(): period does not match choices.")
+    last = min(last, end_date)
+    slices.append((first, last))
+    first = last + timedelta(days=1)
+  return slices
+
+def sacct_shards(flags, start_date, end_date, clusters=[], period="month"):
+  # one shard per cluster (-M replaces -L) and time slice
+  if not clusters: return [(flags, first, last) for first, last in time_slices(start_date, end_date, period)]
+  flags = " ".join([flag for flag in flags.split() if flag != "-L"])
+  return [(f"{flags} -M {cluster}", first, last) for cluster in clusters \
+                                                 for first, last in time_slices(start_date, end_date, period)]
+
+def merge_job_shards(frames):
+  # a job that runs across the boundary of two time slices appears in both shards
+  rw = pd.concat(frames, ignore_index=True)
+  return rw.drop_duplicates(subset=["cluster", "jobid"], keep="last", ignore_index=True)
+
+def load_job_shard(source, fields, renamings=[], numeric_fields=[]):
+  # a shard is a CSV file (e.g., sacct data from a remote cluster) or a file written by jobcache
+  names = [dict(renamings).get(field, field) for field in fields.split(",")]
+  if source.endswith(".csv"):
+    rw = pd.read_csv(source, dtype=str, na_filter=False)
+  elif source.endswith((".feather", ".pickle")):
+    rw = jobcache.read_frame(source)
+  else:
+    sys.exit(f"Error: load_job_shard(): unknown format of {source}.")
+  # validate the schema (raw sacct field names are renamed)
+  rw = rw.rename(columns=renamings)
+  missing = [name for name in names if name not in rw.columns]
+  if missing: sys.exit(f"Error: load_job_shard(): {source} is missing the columns {','.join(missing)}.")
+  extra = [col for col in rw.columns if col not in names]
+  if extra: print(f"W: Ignoring the columns {','.join(extra)} of {source}.")
+  rw = rw[names]
+  for name in names:
+    if name in numeric_fields:
+      rw[name] = pd.to_numeric(rw[name])
+    elif rw[name].dtype != object:
+      rw[name] = rw[name].astype(str)
+  return rw
+
+def fetch_sacct_shards(shards, fields, renamings=[], numeric_fields=[], workers=4, retries=2, timeout=300):
+  def fetch(shard):
+    flags, first, last = shard
+    for attempt in range(retries + 1):
+      try:
+        return stream_sacct(flags, first, last, fields, renamings, numeric_fields, timeout)
+      except subprocess.CalledProcessError as e:
+        if attempt == retries: raise
+        print(f"\nW: sacct failed for {flags} from {first} to {last} (exit {e.returncode}). Retrying.", flush=True)
+        time.sleep(2**attempt)
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    frames = list(executor.map(fetch, shards))
+  return merge_job_shards(frames)
+
+def raw_dataframe_from_sacct(flags, start_date, end_date, fields, basepath, renamings=[], numeric_fields=[], use_cache=False, stream=False,
+                             clusters=None, period=None, workers=4, columns=None, extra_shards=[]):
+  # job shards from other sources (see load_job_shard) are loaded while sacct runs
+  executor = ThreadPoolExecutor(max_workers=max(1, len(extra_shards)))
+  futures = [executor.submit(load_job_shard, shard, fields, renamings, numeric_fields) for shard in extra_shards]
+  # the cache is keyed by the date range, clusters, flags and fields (see jobcache.py)
+  cachedir = f"{basepath}/cache"
+  params = jobcache.cache_params(start_date, end_date, clusters, flags, fields, renamings, numeric_fields)
+  rw = jobcache.read_cache(cachedir, params, columns) if use_cache else None
+  if rw is not None:
+    print("Read sacct data from cache.", flush=True)
   else:
-    cmd = f"sacct {flags} -S {start_date.strftime('%Y-%m-%d')}T00:00:00 -E {end_date.strftime('%Y-%m-%d')}T23:59:59 -o {fields}"
     if use_cache: print("Calling sacct (which may require several seconds) ... ", end="", flush=True)
-    output = subprocess.run(cmd, stdout=subprocess.PIPE, shell=True, timeout=300, text=True, check=True)
+    if clusters is not None or period is not None:
+      shards = sacct_shards(flags, start_date, end_date, clusters, period if period else "month")
+      rw = fetch_sacct_shards(shards, fields, renamings, numeric_fields, workers)
+    elif stream:
+      rw = stream_sacct(flags, start_date, end_date, fields, renamings, numeric_fields)
+    else:
+      cmd = f"sacct {flags} -S {start_date.strftime('%Y-%m-%d')}T00:00:00 -E {end_date.strftime('%Y-%m-%d')}T23:59:59 -o {fields}"
+      output = subprocess.run(cmd, stdout=subprocess.PIPE, shell=True, timeout=300, text=True, check=True)
+      lines = output.stdout.split('\n')
+      if lines != [] and lines[-1] == "": lines = lines[:-1]
+      rw = pd.DataFrame([line.split("|") for line in lines])
+      rw.columns = fields.split(",")
+      rw.rename(columns=renamings, inplace=True)
+      rw[numeric_fields] = rw[numeric_fields].apply(pd.to_numeric)
     if use_cache: print("done.", flush=True)
-    lines = output.stdout.split('\n')
-    if lines != [] and lines[-1] == "": lines = lines[:-1]
-    rw = pd.DataFrame([line.split("|") for line in lines])
-    rw.columns = fields.split(",")
-    rw.rename(columns=renamings, inplace=True)
-    rw[numeric_fields] = rw[numeric_fields].apply(pd.to_numeric)
-    if not email and use_cache: rw.to_csv(fname, index=False)
+    if use_cache: jobcache.write_cache(cachedir, params, rw)
+  if futures:
+    rw = merge_job_shards([rw] + [future.result() for future in futures])
+    print(f"Merged {len(futures)} additional job shard(s).", flush=True)
+  executor.shutdown()
+  if columns: rw = rw[columns]
   return rw
 
 def gpus_per_job(tres):
@@ -126,58 +285,71 @@ def gpus_per_job(tres):
 def is_gpu_job(tres):
   return 1 if "gres/gpu=" in tres and not "gres/gpu=0" in tres else 0
 
-def add_proportion_in_parenthesis(dframe, column_name, replace=False):
-  if dframe.shape[0] == 1: return dframe
-  total = dframe[column_name].sum()
-  if total == 0: return dframe
-  dframe["proportion"] = 100 * dframe[column_name] / total
-  dframe["proportion"] = dframe["proportion"].apply(round)
-  name = column_name if replace else f"{column_name}-cmb"
-  dframe[name] = dframe.apply(lambda row: f"{round(row[column_name])} ({row['proportion']}%)", axis='columns')
-  dframe = dframe.drop(columns=["proportion"])
-  # align cpu-hours by adding spaces before proportion
-  max_chars = max([item.index(")") - item.index("(") for item in dframe[name]])
-  def add_spaces(item):
-    num_spaces_to_add = max_chars - (item.index(")") - item.index("("))
-    return item[:item.index("(")] + " " * num_spaces_to_add + item[item.index("("):]
-  dframe[name] = dframe[name].apply(add_spaces)
-  return dframe
+# partitions with CPU and GPU nodes are split into name(cpu) and name(gpu) according to the job type.
+# a partition of None matches every partition of the cluster.
+SPLIT_PARTITIONS = {("della", "cryoem"):"cryoem",
+                    ("tiger", "cryoem"):"cryoem",
+                    ("della", "gpu-ee"):"gpu-ee",
+                    ("traverse", None):"all"}
 
 def delineate_partitions(cluster, gpu_job, partition):
-  if cluster == "della"   and partition == "cryoem" and gpu_job:
-    return f"{partition}(gpu)"
-  elif cluster == "della" and partition == "cryoem" and not gpu_job:
-    return f"{partition}(cpu)"
-  elif cluster == "tiger" and partition == "cryoem" and gpu_job:
-    return f"{partition}(gpu)"
-  elif cluster == "tiger" and partition == "cryoem" and not gpu_job:
-    return f"{partition}(cpu)"
-  elif cluster == "della" and partition == "gpu-ee" and gpu_job:
-    return f"{partition}(gpu)"
-  elif cluster == "della" and partition == "gpu-ee" and not gpu_job:
-    return f"{partition}(cpu)"
-  elif cluster == "traverse" and gpu_job:
-    return "all(gpu)"
-  elif cluster == "traverse" and not gpu_job:
-    return "all(cpu)"
-  else:
-    return partition
+  name = SPLIT_PARTITIONS.get((cluster, partition), SPLIT_PARTITIONS.get((cluster, None)))
+  if name is None: return partition
+  return f"{name}(gpu)" if gpu_job else f"{name}(cpu)"
+
+def categorical_labels(codes, labels):
+  # ordered categorical equal to labels[codes] built from the codes so that the labels are
+  # stored once instead of being broadcast to an object column (equal labels are merged)
+  categories, inverse = np.unique(labels, return_inverse=True)
+  return pd.Categorical.from_codes(inverse.reshape(-1)[codes], categories=categories, ordered=True)
+
+def map_unique_rows(frame, func, categorical=False):
+  # call func once per distinct row of frame and broadcast the results to all of the rows
+  codes, uniques = pd.MultiIndex.from_frame(frame).factorize()
+  labels = np.array([func(*row) for row in uniques], dtype=object)
+  return categorical_labels(codes, labels) if categorical else labels[codes]
+
+def start_date_labels(start):
+  # the local date only changes on 15-minute boundaries (UTC offsets are multiples of 15 minutes)
+  # so each 15-minute bucket is formatted once
+  codes, buckets = pd.factorize(start.astype("int64") // 900)
+  labels = np.array([datetime.fromtimestamp(int(bucket) * 900).strftime("%a %-m/%-d") for bucket in buckets], dtype=object)
+  return categorical_labels(codes, labels)
 
 def add_new_and_derived_fields(df):
-  df["gpus"] = df.alloctres.apply(gpus_per_job)
-  df["gpu-seconds"] = df.apply(lambda row: row["elapsedraw"] * row["gpus"], axis='columns')
-  df["gpu-job"] = df.alloctres.apply(is_gpu_job)
-  df["cpu-only-seconds"] = df.apply(lambda row: 0 if row["gpu-job"] else row["cpu-seconds"], axis="columns")
-  df["elapsed-hours"] = df.elapsedraw.apply(lambda x: round(x / SECONDS_PER_HOUR, 1))
-  df["start-date"] = df.start.apply(lambda x: datetime.fromtimestamp(int(x)).strftime("%a %-m/%-d"))
+  # the TRES strings repeat so they are parsed once per distinct value
+  codes, tres = pd.factorize(df.alloctres)
+  tres = pd.Series(tres, dtype=object)
+  gpus = tres.str.extract(r".*gres/gpu=(\d+)", expand=False).fillna(0).astype("int64").values
+  gpu_job = (tres.str.contains("gres/gpu=", regex=False) & ~tres.str.contains("gres/gpu=0", regex=False)).astype("int64").values
+  df["gpus"] = gpus[codes]
+  df["gpu-seconds"] = df["elapsedraw"] * df["gpus"]
+  df["gpu-job"] = gpu_job[codes]
+  df["cpu-only-seconds"] = df["cpu-seconds"].where(df["gpu-job"] == 0, 0)
+  codes, elapsed = pd.factorize(df.elapsedraw)
+  df["elapsed-hours"] = np.array([round(x / SECONDS_PER_HOUR, 1) for x in elapsed])[codes]
+  df["start-date"] = start_date_labels(df.start)
   df["cpu-hours"] = df["cpu-seconds"] / SECONDS_PER_HOUR
   df["gpu-hours"] = df["gpu-seconds"] / SECONDS_PER_HOUR
-  df["admincomment"] = df["admincomment"].apply(get_stats_dict)
   # clean partitions for traverse and cryoem (della and tiger)
-  df.partition = df.apply(lambda row: delineate_partitions(row["cluster"], row["gpu-job"], row["partition"]), axis="columns")
-  df["cluster-partition"] = df.apply(lambda row: f"{row['cluster']}__{row['partition']}", axis="columns")
+  df.partition = map_unique_rows(df[["cluster", "gpu-job", "partition"]], delineate_partitions, categorical=True)
+  df["cluster-partition"] = map_unique_rows(df[["cluster", "partition"]], lambda cluster, partition: f"{cluster}__{partition}", categorical=True)
   return df
 
+def compact_job_table(df, categoricals=["netid", "cluster", "partition", "account", "alloctres", "cluster-partition", "start-date"]):
+  # Strings with few distinct values become (ordered) categoricals so that each label is stored
+  # once and sorting/min/max behave as for strings. Integer counters are downcast to the smallest
+  # width that fits. The large admincomment column is returned separately (aligned on the index)
+  # so that it can be released as soon as the efficiencies have been computed.
+  admincomment = df.pop("admincomment") if "admincomment" in df.columns else None
+  # partition, cluster-partition and start-date are already built as categoricals
+  for col in categoricals:
+    if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+      df[col] = df[col].astype(pd.CategoricalDtype(sorted(df[col].unique()), ordered=True))
+  for col in df.select_dtypes(include="integer").columns:
+    df[col] = pd.to_numeric(df[col], downcast="integer")
+  return df, admincomment
+
 def uniq_series(series):
   return ",".join(sorted(set(series)))
 
@@ -198,7 +370,10 @@ def format_user_name(s):
 
 def groupby_cluster_partition_netid_and_get_sponsor(df, user_sponsor):
   d = {"cpu-hours":np.sum, "gpu-hours":np.sum, "netid":np.size, "partition":min, "account":uniq_series}
-  dg = df.groupby(by=["cluster-partition", "netid"]).agg(d).rename(columns={"netid":"jobs"}).reset_index()
+  dg = df.groupby(by=["cluster-partition", "netid"], observed=True).agg(d).rename(columns={"netid":"jobs"}).reset_index()
+  # the grouped frame is small so categoricals of a compact job table are turned back into strings
+  categoricals = dg.select_dtypes(include="category").columns
+  dg[categoricals] = dg[categoricals].astype(object)
   dg["cluster"] = dg["cluster-partition"].apply(lambda x: x.split("__")[0])
   dg = dg.merge(user_sponsor, on="netid", how="left")
   dg["sponsor"] = dg.apply(lambda row: row["sponsor-dict"][row["cluster"]], axis='columns')
@@ -208,47 +383,104 @@ def groupby_cluster_partition_netid_and_get_sponsor(df, user_sponsor):
   dg["gpu-hours"] = dg["gpu-hours"].apply(round).astype("int64")
   return dg
 
-def compute_cpu_and_gpu_efficiencies(df, clusparts):
+def process_pool(workers):
+  # the worker processes are spawned instead of forked since the pools may be started while
+  # other threads (e.g., the SMTP senders) hold locks that a forked child would inherit
+  return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+def usage_batch(batch):
+  # decode the jobstats of each job of the batch and return only its used and total CPU and
+  # GPU seconds (None for a job without jobstats) so that the workers send four numbers per
+  # job back to the parent instead of the decoded jobstats
+  usage = []
+  for admincomment, elapsedraw, jobid, cluster, is_gpu in batch:
+    stats = admincomment if isinstance(admincomment, dict) else get_stats_dict(admincomment)
+    if stats == {}:
+      usage.append(None)
+      continue
+    cpu = cpu_efficiency(stats, elapsedraw, jobid, cluster)
+    gpu = gpu_efficiency(stats, elapsedraw, jobid, cluster) if is_gpu else (np.nan, np.nan)
+    usage.append((cpu[0], cpu[1], gpu[0], gpu[1]))
+  return usage
+
+def decode_usage(jobs, admincomment, is_gpu, workers=os.cpu_count(), batchsize=5000):
+  # decoding the jobstats in admincomment is the heaviest CPU work so it is done in batches
+  # over a pool of processes (the results are returned in order). Returns the four usage
+  # columns of the jobs with jobstats.
+  values = list(zip(admincomment.tolist(), jobs.elapsedraw.tolist(), jobs.jobid.tolist(),
+                    jobs.cluster.tolist(), is_gpu.tolist()))
+  batches = [values[i:i + batchsize] for i in range(0, len(values), batchsize)]
+  if workers and workers > 1 and len(batches) > 1:
+    with process_pool(min(workers, len(batches))) as executor:
+      decoded = [usage for batch in executor.map(usage_batch, batches) for usage in batch]
+  else:
+    decoded = [usage for batch in batches for usage in usage_batch(batch)]
+  keep = [i for i, usage in enumerate(decoded) if usage is not None]
+  return pd.DataFrame([decoded[i] for i in keep], index=jobs.index[keep], columns=effcache.COLUMNS, dtype="float64")
+
+def job_usage(df, admincomment, workers=os.cpu_count(), cache=None):
+  # Return the used and total CPU and GPU seconds (GPU only on GPU partitions) of the jobs
+  # with jobstats. Finished jobs never change so the numbers are taken from the cache
+  # when possible and admincomment is only decoded for the misses.
+  is_gpu = df["cluster-partition"].isin(GPU_CLUSTER_PARTITIONS)
+  if cache is not None:
+    usage = cache.lookup(df.cluster, df.jobid)
+    hit = usage["cpu-seconds-used"].notna() & (usage["gpu-seconds-used"].notna() | ~is_gpu)
+  else:
+    usage = pd.DataFrame(np.nan, index=df.index, columns=effcache.COLUMNS)
+    hit = pd.Series(False, index=df.index)
+  misses = (~hit)[~hit].index
+  new = decode_usage(df.loc[misses], admincomment[misses], is_gpu[misses], workers)
+  jobs = df.loc[new.index]
+  if cache is not None and not new.empty: cache.store(jobs.cluster, jobs.jobid, new)
+  usage.loc[new.index] = new
+  return usage[usage["cpu-seconds-used"].notna()]
+
+def format_efficiency(used, total):
+  # percent as a string (e.g., 87%) or -- when nothing was allocated
+  with np.errstate(divide="ignore", invalid="ignore"):
+    percent = np.rint(100.0 * used / total)
+  percent = pd.Series(percent, index=used.index).where(total != 0, 0).astype("int64").astype(str) + "%"
+  return percent.where(total != 0, "--")
+
+def compute_cpu_and_gpu_efficiencies(df, clusparts, admincomment=None, workers=os.cpu_count(), cache=None):
   # Here we create a new dataframe containing the efficiencies.
   # This is good to do in isolation since we may need to filter out some jobs and
   # a lot can go wrong in general when computing these quantities.
   # Idea is to join this with the main dataframe and run fillna in
   # case the jobs of a user got filtered out when computing efficiencies.
 
-  eff = pd.DataFrame()
-  for cluspart in clusparts:
-    ce = df[(df["cluster-partition"] == cluspart) & \
-            (df["elapsedraw"] >= 0.1 * SECONDS_PER_HOUR) & \
-            (df.admincomment != {})].copy()
-    if ce.empty: continue  # prevents next line from failing
-    ce[f"cpu-tuples"] = ce.apply(lambda row: cpu_efficiency(row["admincomment"], row["elapsedraw"], row["jobid"], row["cluster"]), axis="columns")
-    ce[f"cpu-seconds-used"]  = ce[f"cpu-tuples"].apply(lambda x: x[0])
-    ce[f"cpu-seconds-total"] = ce[f"cpu-tuples"].apply(lambda x: x[1])
-    if cluspart in GPU_CLUSTER_PARTITIONS:
-      ce[f"gpu-tuples"] = ce.apply(lambda row: gpu_efficiency(row["admincomment"], row["elapsedraw"], row["jobid"], row["cluster"]), axis="columns")
-      ce[f"gpu-seconds-used"]  = ce[f"gpu-tuples"].apply(lambda x: x[0])
-      ce[f"gpu-seconds-total"] = ce[f"gpu-tuples"].apply(lambda x: x[1])
-    before = ce.shape[0]
-    ce = ce[ce[f"cpu-seconds-used"] <= ce[f"cpu-seconds-total"]]  # dropping bad data
-    if (before - ce.shape[0] > 0): print(f"W: Dropped {before - ce.shape[0]} rows of {before} on {cluspart} while computing CPU efficiencies")
-    if cluspart in GPU_CLUSTER_PARTITIONS:
-      before = ce.shape[0]
-      ce = ce[ce[f"gpu-seconds-used"] <= ce[f"gpu-seconds-total"]]
-      if (before - ce.shape[0] > 0): print(f"W: Dropped {before - ce.shape[0]} rows of {before} on {cluspart} while computing GPU efficiencies")
-    if cluspart not in GPU_CLUSTER_PARTITIONS:
-      d = {"netid":np.size, "cpu-seconds-used":np.sum, "cpu-seconds-total":np.sum}
-      ce = ce.groupby("netid").agg(d).rename(columns={"netid":"jobs"}).reset_index(drop=False)
-      ce["CPU-eff"] = ce.apply(lambda row: f'{round(100.0 * row["cpu-seconds-used"] / row["cpu-seconds-total"])}%' if row["cpu-seconds-total"] != 0 else "--", axis="columns")
-      ce["GPU-eff"] = "N/A"
-    else:
-      d = {"netid":np.size, "cpu-seconds-used":np.sum, "cpu-seconds-total":np.sum, "gpu-seconds-used":np.sum, "gpu-seconds-total":np.sum}
-      ce = ce.groupby("netid").agg(d).rename(columns={"netid":"jobs"}).reset_index(drop=False)
-      ce["CPU-eff"] = ce.apply(lambda row: f'{round(100.0 * row["cpu-seconds-used"] / row["cpu-seconds-total"])}%' if row["cpu-seconds-total"] != 0 else "--", axis="columns")
-      ce["GPU-eff"] = ce.apply(lambda row: f'{round(100.0 * row["gpu-seconds-used"] / row["gpu-seconds-total"])}%' if row["gpu-seconds-total"] != 0 else "--", axis="columns")
-    ce["cluster-partition"] = cluspart
-    ce = ce[["netid", "CPU-eff", "GPU-eff", "cluster-partition"]]
-    eff = pd.concat([eff, ce])
-  return eff
+  # admincomment may be stored outside of df (see compact_job_table). It is only
+  # decoded for the jobs that are long enough to be included and not in the cache.
+  if admincomment is None: admincomment = df.admincomment
+  long_enough = df["elapsedraw"] >= 0.1 * SECONDS_PER_HOUR
+  usage = job_usage(df[long_enough], admincomment, workers, cache)
+  jobs = df.loc[usage.index, ["netid", "cluster-partition"]].join(usage)
+  jobs["cluster-partition"] = jobs["cluster-partition"].astype(str)
+  jobs = jobs[jobs["cluster-partition"].isin(clusparts)]
+
+  # dropping bad data (the GPU check is made on the jobs that passed the CPU check)
+  is_gpu = jobs["cluster-partition"].isin(GPU_CLUSTER_PARTITIONS)
+  good_cpu = jobs["cpu-seconds-used"] <= jobs["cpu-seconds-total"]
+  good_gpu = ~is_gpu | (jobs["gpu-seconds-used"] <= jobs["gpu-seconds-total"])
+  cp = jobs["cluster-partition"]
+  counts = pd.DataFrame({"cpu-before": cp.value_counts(),
+                         "cpu-after":  cp[good_cpu].value_counts(),
+                         "gpu-after":  cp[good_cpu & good_gpu].value_counts()}).fillna(0).astype("int64")
+  for cluspart, row in counts.sort_index().iterrows():
+    dropped = row["cpu-before"] - row["cpu-after"]
+    if (dropped > 0): print(f"W: Dropped {dropped} rows of {row['cpu-before']} on {cluspart} while computing CPU efficiencies")
+    dropped = row["cpu-after"] - row["gpu-after"]
+    if (cluspart in GPU_CLUSTER_PARTITIONS and dropped > 0): print(f"W: Dropped {dropped} rows of {row['cpu-after']} on {cluspart} while computing GPU efficiencies")
+  jobs = jobs[good_cpu & good_gpu]
+
+  # one groupby over all cluster-partitions
+  cols = ["cpu-seconds-used", "cpu-seconds-total", "gpu-seconds-used", "gpu-seconds-total"]
+  eff = jobs.groupby(["cluster-partition", "netid"], observed=True)[cols].sum().reset_index(drop=False)
+  eff["CPU-eff"] = format_efficiency(eff["cpu-seconds-used"], eff["cpu-seconds-total"])
+  eff["GPU-eff"] = format_efficiency(eff["gpu-seconds-used"], eff["gpu-seconds-total"])
+  eff["GPU-eff"] = eff["GPU-eff"].where(eff["cluster-partition"].isin(GPU_CLUSTER_PARTITIONS), "N/A")
+  return eff[["netid", "CPU-eff", "GPU-eff", "cluster-partition"]]
 
 def check_for_nulls(dg):
   if not dg[pd.isna(dg["sponsor"])].empty:
@@ -260,17 +492,25 @@ def check_for_nulls(dg):
   return None
 
 def add_cpu_and_gpu_rankings(dg, x):
-  def cpu_ranking(cluspart, user, cpuhours):
-    cpu_hours_rank = pd.Index(x[x["cluster-partition"] == cluspart].sort_values(by="cpu-hours", ascending=False).netid).get_loc(user) + 1
-    total_users    = x[x["cluster-partition"] == cluspart]["netid"].unique().size
-    return f"{total_users}/{total_users}" if cpuhours == 0 else f"{cpu_hours_rank}/{total_users}"
-  def gpu_ranking(cluspart, user, gpuhours):
-    if cluspart not in GPU_CLUSTER_PARTITIONS: return "N/A"
-    gpu_hours_rank = pd.Index(x[x["cluster-partition"] == cluspart].sort_values(by="gpu-hours", ascending=False).netid).get_loc(user) + 1
-    total_users    = x[x["cluster-partition"] == cluspart]["netid"].unique().size
-    return f"{total_users}/{total_users}" if gpuhours == 0 else f"{gpu_hours_rank}/{total_users}"
-  dg["CPU-rank"] = dg.apply(lambda row: cpu_ranking(row["cluster-partition"], row["netid"], row["cpu-hours"]), axis="columns")
-  dg["GPU-rank"] = dg.apply(lambda row: gpu_ranking(row["cluster-partition"], row["netid"], row["gpu-hours"]), axis="columns")
+  # Rank the users of each cluster-partition of x by hours (descending) and add the ranks
+  # to the rows of dg as "rank/users". Ties in hours are broken by netid (ascending). Users
+  # with zero hours are shown as N/N where N is the number of users of the cluster-partition
+  # and the GPU rank is N/A on CPU partitions.
+  x = x[["cluster-partition", "netid", "cpu-hours", "gpu-hours"]].drop_duplicates(subset=["cluster-partition", "netid"])
+  def ranks(hours):
+    ordered = x.sort_values(["cluster-partition", hours, "netid"], ascending=[True, False, True], kind="mergesort")
+    return ordered.groupby("cluster-partition", observed=True).cumcount().add(1).reindex(x.index)
+  table = pd.DataFrame({"cpu-rank":ranks("cpu-hours"),
+                        "gpu-rank":ranks("gpu-hours"),
+                        "users":x.groupby("cluster-partition", observed=True)["netid"].transform("nunique")})
+  table.index = pd.MultiIndex.from_frame(x[["cluster-partition", "netid"]])
+  table = table.reindex(pd.MultiIndex.from_frame(dg[["cluster-partition", "netid"]])).astype("int64")
+  users = table["users"].astype(str)
+  cpu_rank = (table["cpu-rank"].astype(str) + "/" + users).where(dg["cpu-hours"].values != 0, users + "/" + users)
+  gpu_rank = (table["gpu-rank"].astype(str) + "/" + users).where(dg["gpu-hours"].values != 0, users + "/" + users)
+  gpu_rank = gpu_rank.where(dg["cluster-partition"].isin(GPU_CLUSTER_PARTITIONS).values, "N/A")
+  dg["CPU-rank"] = cpu_rank.values
+  dg["GPU-rank"] = gpu_rank.values
   return dg
 
 def collapse_by_sponsor(dg):
@@ -279,15 +519,32 @@ def collapse_by_sponsor(dg):
   sg = sg.sort_values(["cluster", "sponsor", "cpu-hours"], ascending=[True, True, False])
   return sg
 
-def add_heading(df_str, cluster):
-  rows = df_str.split("\n")
-  width = max([len(row) for row in rows])
-  padding = " " * max(1, math.ceil((width - len(cluster)) / 2))
-  divider = padding + cluster[0].upper() + cluster[1:] + padding
-  rows.insert(0, divider)
-  rows.insert(1, "-" * len(divider))
-  rows.insert(3, "-" * len(divider))
-  return "\n".join(rows)
+def sponsor_summary(ov):
+  # One row per (cluster, sponsor) with the CPU and GPU hours of the group, the percent of
+  # the total hours on the cluster, the rank of the group by hours (ties are broken by sponsor
+  # and groups with zero hours are ranked last) and the number of sponsors on the cluster
+  # (users without a sponsor count as one sponsor as in the totals).
+  hours = ["cpu-hours", "gpu-hours"]
+  sm = ov.groupby(["cluster", "sponsor"])[hours].sum().reset_index()
+  totals = ov.groupby("cluster")[hours].sum()
+  total_sponsors = ov.groupby("cluster")["sponsor"].nunique(dropna=False)
+  sm["total-sponsors"] = sm.cluster.map(total_sponsors)
+  for x in ("cpu", "gpu"):
+    total = sm.cluster.map(totals[f"{x}-hours"])
+    sm[f"{x}-hours-total"] = total
+    # format_percent returns int, float or str so the column holds Python objects (as printed)
+    pct = [0 if t == 0 else format_percent(100 * h / t) for h, t in zip(sm[f"{x}-hours"], total)]
+    sm[f"{x}-hours-pct"] = pd.Series(pct, index=sm.index, dtype=object)
+    ordered = sm.sort_values(["cluster", f"{x}-hours", "sponsor"], ascending=[True, False, True], kind="mergesort")
+    sm[f"{x}-hours-rank"] = ordered.groupby("cluster").cumcount().add(1).reindex(sm.index)
+    sm[f"{x}-hours-rank"] = sm[f"{x}-hours-rank"].where(sm[f"{x}-hours"] != 0, sm["total-sponsors"])
+  return sm.set_index(["cluster", "sponsor"])
+
+def report_plan(frame, key, sort_by=None):
+  # partition frame once into a dictionary of recipient (the value of the key column)
+  # to its rows (in the order of frame or stably sorted by sort_by)
+  if sort_by: frame = frame.sort_values(sort_by, kind="mergesort")
+  return {recipient: rows for recipient, rows in frame.groupby(key, sort=False)}
 
 def format_percent(x):
   if x >= 10:
@@ -306,6 +563,85 @@ def special_requests(sponsor, cluster, cl, start_date, end_date):
   else:
     return ""
 
+def integer_columns(frame, cols):
+  return [pd.api.types.is_integer_dtype(frame[col]) for col in cols]
+
+def sponsor_cluster_table(cl):
+  # users of a sponsor on one cluster (rows of collapse_by_sponsor) with the proportion of CPU-hours
+  cpu_hours, cpu_numeric = render.proportions(cl["cpu-hours"].tolist())
+  headers = ["NetID", "Name", "CPU-hours", "GPU-hours", "Jobs", "Account", "Partition"]
+  columns = [cl.netid.tolist(), cl.name.tolist(), cpu_hours, cl["gpu-hours"].tolist(), cl.jobs.tolist(),
+             [uniq_series(x.split(",")) for x in cl.account], cl.partition.tolist()]
+  numeric = [False, False, cpu_numeric and integer_columns(cl, ["cpu-hours"])[0]] + integer_columns(cl, ["gpu-hours", "jobs"]) + [False, False]
+  return render.render_table(headers, columns, numeric)
+
+def gpu_columns(rows, mask_rank=True):
+  # GPU-hours, GPU-rank and GPU-eff with N/A on CPU partitions (and -- for the efficiency on mig)
+  is_gpu = rows["cluster-partition"].isin(GPU_CLUSTER_PARTITIONS).tolist()
+  gpu_hours = render.mask(rows["gpu-hours"].tolist(), is_gpu, "N/A")
+  gpu_rank = render.mask(rows["GPU-rank"].tolist(), is_gpu, "N/A") if mask_rank else rows["GPU-rank"].tolist()
+  gpu_eff = render.mask(render.mask(rows["GPU-eff"].tolist(), is_gpu, "N/A"), [p != "mig" for p in rows.partition], "--")
+  numeric = [all(is_gpu) and integer_columns(rows, ["gpu-hours"])[0], False, False]
+  return any(is_gpu), [gpu_hours, gpu_rank, gpu_eff], numeric
+
+def details_table(rows):
+  # detailed breakdown of the users of a sponsor (rows of dg)
+  rows = rows.sort_values(["cluster", "netid", "partition"])
+  headers = ["Cluster", "NetID", "Partition", "CPU-hours", "CPU-rank", "CPU-eff"]
+  columns = [[f"{x[0].upper()}{x[1:]}" for x in rows.cluster], rows.netid.tolist(), rows.partition.tolist(),
+             rows["cpu-hours"].tolist(), rows["CPU-rank"].tolist(), rows["CPU-eff"].tolist()]
+  numeric = [False, False, False] + integer_columns(rows, ["cpu-hours"]) + [False, False]
+  any_gpu, gpu, gpu_numeric = gpu_columns(rows)
+  if any_gpu:
+    headers += ["GPU-hours", "GPU-rank", "GPU-eff"]
+    columns += gpu
+    numeric += gpu_numeric
+  headers.append("Jobs")
+  columns.append(rows.jobs.tolist())
+  numeric += integer_columns(rows, ["jobs"])
+  return render.render_table(headers, columns, numeric)
+
+def user_table(rows):
+  # usage of a user per cluster-partition (rows of dg)
+  headers = ["Cluster", "Partition", "CPU-hours", "CPU-rank", "CPU-eff"]
+  columns = [rows.cluster.tolist(), rows.partition.tolist(), rows["cpu-hours"].tolist(), rows["CPU-rank"].tolist(), rows["CPU-eff"].tolist()]
+  numeric = [False, False] + integer_columns(rows, ["cpu-hours"]) + [False, False]
+  any_gpu, gpu, gpu_numeric = gpu_columns(rows, mask_rank=False)
+  if any_gpu:
+    headers += ["GPU-hours", "GPU-rank", "GPU-eff"]
+    columns += gpu
+    numeric += gpu_numeric
+  headers += ["Jobs", "Account", "Sponsor"]
+  columns += [rows.jobs.tolist(), rows.account.tolist(), rows.sponsor.tolist()]
+  numeric += integer_columns(rows, ["jobs"]) + [False, False]
+  return render.render_table(headers, columns, numeric)
+
+def base2to10(x):
+  if x < 1024:
+    return f"{x} B"
+  elif x < 1024**2:
+    return f"{round(x / 1024)} KB"
+  elif x < 1024**3:
+    return f"{round(x / 1024**2)} MB"
+  elif x < 1024**4:
+    return f"{round(x / 1024**3)} GB"
+  elif x < 1024**5:
+    return f"{round(x / 1024**4)} TB"
+  elif x < 1024**6:
+    return f"{round(x / 1024**5)} PB"
+
+def projects_table(st):
+  # storage of the users of a fileset (list of netid, uid and amount in bytes) from largest to smallest
+  st = pd.DataFrame(st, columns=["NetID", "UID", "Amount2"]).sort_values("Amount2", ascending=False)
+  amounts = st.Amount2.tolist()
+  items, single = render.proportions(amounts)
+  proportions = ["(100%)" if single else item.split()[1] for item in items]
+  column = []
+  for amt, pro in zip(map(base2to10, amounts), proportions):
+    column.append(f"{amt} {pro}" if pro == "(100%)" else amt + " " * (6 - len(pro)) + pro)
+  return render.render_table(["NetID", "UID", "    Amount    "], [st.NetID.tolist(), st.UID.tolist(), column],
+                             integer_columns(st, ["NetID", "UID"]) + [False])
+
 def create_user_report(name, netid, start_date, end_date, body):
   if netid == "cpena":   name = "Catherine J. Pena"
   if netid == "javalos": name = "Jose L. Avalos"
@@ -404,6 +740,120 @@ def create_report(name, sponsor, start_date, end_date, body):
   report += "\n".join(textwrap.wrap(footer, width=75))
   return report
 
+def sponsor_storage(sponsor, sp, usage, ids, filesets, index):
+  # storage of the users of a sponsor from the block usage (uid -> key -> bytes): /scratch/gpfs per
+  # cluster (not shown in the reports yet) and /projects per fileset of the sponsor as lists of
+  # netid, uid and amount from the fileset index of the block usage (see DataStorage.fileset_index)
+  scratch = {}
+  for cluster in ("della", "stellar", "tiger"):
+    key = f"{cluster}.gpfs.root"
+    st = []
+    for n in sp[sp.cluster == cluster].netid:
+      uid = ids.uid(n)
+      if uid and usage.get(uid, {}).get(key):
+        st.append([n, uid, usage[uid][key]])
+    if st: scratch[cluster] = st
+  projects = []
+  for myfs in filesets.get(sponsor, []):
+    st = [row for row in index.get(f"projects2.storage.{myfs}", []) if row[1] != myfs and row[2]]
+    if st: projects.append((myfs, st))
+  return scratch, projects
+
+def render_user_report(user, name, rows, start_date, end_date):
+  # report of a user from the rows of the user in dg (the inputs are plain data so that
+  # the reports can be rendered in worker processes)
+  body = "\n".join([2 * " " + row for row in user_table(rows).split("\n")])
+  body += "\n\n"
+  return create_user_report(name, user, start_date, end_date, body)
+
+def render_sponsor_report(sponsor, name, sp, details, summary, projects, start_date, end_date):
+  # report of a sponsor from the rows of the sponsor in collapse_by_sponsor (sp) and dg (details),
+  # the rows of the sponsor in sponsor_summary (indexed by cluster) and the /projects usage
+  # the rows are read as dictionaries so that the values keep the types of their columns
+  summary = summary.to_dict("index")
+  body = ""
+  for cluster in ("della", "stellar", "tiger", "traverse"):
+    cl = sp[sp.cluster == cluster]
+    if not cl.empty:
+      # where the group ranks relative to other groups is looked up in the summary
+      sm = summary[cluster]
+      cpu_hours_by_sponsor, gpu_hours_by_sponsor = sm["cpu-hours"], sm["gpu-hours"]
+      cpu_hours_total, gpu_hours_total = sm["cpu-hours-total"], sm["gpu-hours-total"]
+      cpu_hours_pct, gpu_hours_pct = sm["cpu-hours-pct"], sm["gpu-hours-pct"]
+      cpu_hours_rank, gpu_hours_rank = sm["cpu-hours-rank"], sm["gpu-hours-rank"]
+      total_sponsors = sm["total-sponsors"]
+
+      body += "\n"
+      body += add_heading(sponsor_cluster_table(cl), cluster)
+      body += special_requests(sponsor, cluster, cl, start_date, end_date)
+      body += f"\n\nYour group used {cpu_hours_by_sponsor} CPU-hours or {cpu_hours_pct}% of the {cpu_hours_total} total CPU-hours"
+      body += f"\non {cluster[0].upper() + cluster[1:]}. Your group is ranked {cpu_hours_rank} of {total_sponsors} by CPU-hours used."
+      if gpu_hours_by_sponsor != 0:
+        body +=  " Similarly,"
+        body += f"\nyour group used {gpu_hours_by_sponsor} GPU-hours or {gpu_hours_pct}% of the {gpu_hours_total} total GPU-hours"
+        body += f"\nwhich yields a ranking of {gpu_hours_rank} of {total_sponsors} by GPU-hours used."
+      body += "\n\n"
+
+  # details table
+  body += "\n"
+  body += render.add_divided_heading(details_table(details), "Detailed Breakdown")
+
+  # /projects
+  for i, (myfs, st) in enumerate(projects):
+    if i == 0:
+      body += "\n" + "We are beginning to include storage information in these reports. Below is \nyour accounting for /projects as of today:\n\n"
+    body += "\n"
+    body += render.add_divided_heading(projects_table(st), f"/projects/{myfs}")
+  return create_report(name, sponsor, start_date, end_date, body)
+
+def render_reports(func, tasks, workers=os.cpu_count(), window=32):
+  # render the reports (func(*task) for each task) over a pool of processes when workers > 1.
+  # the reports are yielded in the order of the tasks so the output does not depend on workers
+  # and at most window reports are rendered ahead of the consumer
+  if not (workers and workers > 1 and len(tasks) > 1):
+    for task in tasks:
+      yield func(*task)
+    return
+  with process_pool(min(workers, len(tasks))) as executor:
+    futures = deque()
+    try:
+      for task in tasks:
+        futures.append(executor.submit(func, *task))
+        if len(futures) >= window: yield futures.popleft().result()
+      while futures:
+        yield futures.popleft().result()
+    finally:
+      for future in futures: future.cancel()
+
+def pipeline_reports(reports, consume, send, senders=1, maxsize=32):
+  # consume(i, report) is called for the reports in order in this thread (printing, spooling)
+  # and returns the addressees of the report. the emails go through a bounded queue to sender
+  # threads so that the first reports are sent while later reports are still rendered. when
+  # the senders fall behind the queue is full and rendering waits. the first error stops the
+  # pipeline (emails already in the queue are dropped after an error in a sender) and is raised.
+  emails = queue.Queue(maxsize)
+  errors = []
+  def sender():
+    while True:
+      item = emails.get()
+      if item is None: return
+      if errors: continue
+      try:
+        send(*item)
+      except Exception as error:
+        errors.append(error)
+  threads = [threading.Thread(target=sender, daemon=True) for _ in range(max(1, senders))]
+  for thread in threads: thread.start()
+  try:
+    for i, report in enumerate(reports):
+      if errors: break
+      for addressee in consume(i, report):
+        emails.put((report, addressee))
+  finally:
+    if hasattr(reports, "close"): reports.close()
+    for _ in threads: emails.put(None)
+    for thread in threads: thread.join()
+  if errors: raise errors[0]
 
 if __name__ == "__main__":
 
@@ -420,13 +870,51 @@ if __name__ == "__main__":
                       help='Specify the path to this script')
   parser.add_argument('--email', action='store_true', default=False,
                       help='Flag to send reports via email')
+  parser.add_argument('--workers', type=int, default=4, metavar='N',
+                      help='Number of concurrent sacct and LDAP calls (default: 4)')
+  parser.add_argument('--archive', action='store_true', default=False,
+                      help='Read finished jobs from the job archive (see ingest.py)')
+  parser.add_argument('--shard', action='append', default=[], metavar='FILE',
+                      help='Merge the jobs in FILE (CSV or cache file) with the sacct data (repeatable)')
+  parser.add_argument('--refresh-ldap', action='store_true', default=False,
+                      help='Ignore the LDAP cache and look up all sponsors and names again')
+  parser.add_argument('--offline', action='store_true', default=False,
+                      help='Only use the LDAP cache (dry runs without LDAP)')
+  parser.add_argument('--processes', type=int, default=os.cpu_count(), metavar='N',
+                      help='Number of processes that render the reports (default: all cores)')
+  parser.add_argument('--senders', type=int, default=2, metavar='N',
+                      help='Number of threads (and SMTP connections) that send the emails (default: 2)')
+  parser.add_argument('--mail-rate', type=float, default=10, metavar='R',
+                      help='Maximum number of emails sent per second (default: 10)')
+  parser.add_argument('--spool', action='store_true', default=False,
+                      help='Write the reports to a spool directory and send them from there (over the --senders threads)')
+  parser.add_argument('--resume', action='store_true', default=False,
+                      help='Send the reports of the spool that were not sent (no sacct, LDAP or aggregation)')
 
   args = parser.parse_args()
+  if args.offline and args.email: parser.error("--offline cannot be used with --email")
   #start_date = datetime.strptime(args.start, '%Y-%m-%d')
   #end_date   = datetime.strptime(args.end,   '%Y-%m-%d')
   start_date, end_date = get_date_range(date.today(), args.months, report_type=args.report_type)
   print(f"\nReporting period: {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}")
 
+  # persistent SMTP connections (one per sender thread) for all of the emails of the run
+  smtp = mailer.Mailer(connections=args.senders, rate=args.mail_rate)
+
+  # spooled reports of this period (a run that died while sending is resumed with --resume)
+  outbox = spool.Spool(spool.run_dir(f"{args.basepath}/spool", args.report_type, start_date, end_date))
+  if args.resume:
+    if outbox.manifest() is None: sys.exit(f"Error: no complete spool in {outbox.path}.")
+    pending = outbox.pending()
+    print(f"{len(pending)} of {len(pending) + len(outbox.delivered())} emails in {outbox.path} were not sent.")
+    if args.email:
+      sent = outbox.drain(lambda report, addressee: send_email(report, addressee, start_date, end_date, smtp=smtp),
+                          senders=args.senders)
+      print(f"Sent {sent} emails.")
+    smtp.close()
+    sys.exit(0)
+  if args.spool and outbox.delivered(): sys.exit(f"Error: reports in {outbox.path} were already sent. Use --resume.")
+
   # pandas display settings
   pd.set_option("display.max_rows", None)
   pd.set_option("display.max_columns", None)
@@ -435,11 +923,27 @@ if __name__ == "__main__":
   # convert Slurm timestamps to seconds
   os.environ["SLURM_TIME_FORMAT"] = "%s"
 
-  flags = "-L -a -X -P -n"
-  fields = "jobid,user,cluster,account,partition,cputimeraw,elapsedraw,timelimitraw,nnodes,ncpus,alloctres,submit,eligible,start,admincomment"
-  renamings = {"user":"netid", "cputimeraw":"cpu-seconds", "nnodes":"nodes", "ncpus":"cores", "timelimitraw":"limit-minutes"}
-  numeric_fields = ["cpu-seconds", "elapsedraw", "limit-minutes", "nodes", "cores", "submit", "eligible"]
-  df = raw_dataframe_from_sacct(flags, start_date, end_date, fields, args.basepath, renamings, numeric_fields, email=args.email, use_cache=True)
+  # shard the sacct query by cluster and by month (sponsors) or week (users)
+  period = "month" if args.report_type == "sponsors" else "week"
+  clusters = get_cluster_names()
+  archive = f"{args.basepath}/jobs"
+  watermark = jobcache.read_watermark(archive) if args.archive else None
+  if args.archive and watermark is None: print(f"W: No job archive found in {archive}. Calling sacct for the full period.")
+  if watermark is None:
+    df = raw_dataframe_from_sacct(SACCT_FLAGS, start_date, end_date, SACCT_FIELDS, args.basepath, SACCT_RENAMINGS, SACCT_NUMERIC_FIELDS,
+                                  use_cache=True, stream=True, clusters=clusters, period=period, workers=args.workers,
+                                  columns=SACCT_REPORT_COLUMNS, extra_shards=args.shard)
+  else:
+    # finished jobs come from the archive (see ingest.py) and sacct is only called for the
+    # days after the watermark plus the last day of the period (jobs still running at the end)
+    print(f"Reading job archive (watermark {watermark.isoformat(timespec='minutes')}) ... ", end="", flush=True)
+    df = jobcache.read_archive(archive, start_date, end_date, columns=SACCT_REPORT_COLUMNS)
+    print("done.", flush=True)
+    gap_start = max(start_date, min(watermark.date(), end_date))
+    gap = raw_dataframe_from_sacct(SACCT_FLAGS, gap_start, end_date, SACCT_FIELDS, args.basepath, SACCT_RENAMINGS, SACCT_NUMERIC_FIELDS,
+                                   stream=True, clusters=clusters, period="week", workers=args.workers,
+                                   columns=SACCT_REPORT_COLUMNS, extra_shards=args.shard)
+    df = merge_job_shards([df, gap])
 
   # filter pending jobs and clean
   df = df[pd.notnull(df.alloctres) & (df.alloctres != "")]
@@ -456,6 +960,7 @@ if __name__ == "__main__":
 
   if not args.email: print("Adding new and derived fields (which may require several seconds) ... ", end="", flush=True)
   df = add_new_and_derived_fields(df)
+  df, admincomment = compact_job_table(df)
   if not args.email: print("done.", flush=True)
 
   # partitions
@@ -465,23 +970,29 @@ if __name__ == "__main__":
   print("\n")
   print("Be sure to explicitly specify the GPU cluster-partitions in GPU_CLUSTER_PARTITIONS.")
   print("GPU cluster-partitions are denoted by ***GPU*** below:")
-  clusparts = np.sort(df["cluster-partition"].unique())
+  clusparts = np.sort(np.asarray(df["cluster-partition"].unique()))
   for cluspart in clusparts:
     stars = "***GPU***" if cluspart in GPU_CLUSTER_PARTITIONS else 9 * " "
     print(f"{stars} {cluspart}")
   print("\n\n")
 
   # get sponsor info for each unique netid (this minimizes ldap calls)
-  user_sponsor = df[["netid"]].drop_duplicates().sort_values("netid").copy()
+  user_sponsor = df[["netid"]].drop_duplicates().astype(str).sort_values("netid")
   if not args.email: print("Getting sponsor for each user (which may require several seconds) ... ", end="\n", flush=True)
-  user_sponsor["sponsor-dict"] = user_sponsor.netid.apply(lambda netid: get_sponsor_netid_per_cluster_dict_from_ldap(netid, verbose=True))
+  ldap_cache = ldapcache.LdapCache(f"{args.basepath}/cache/ldap.sqlite", refresh=args.refresh_ldap, offline=args.offline)
+  sponsor_dicts = ldapcache.get_sponsor_dicts(ldap_cache, user_sponsor.netid.tolist(), verbose=True, workers=args.workers)
+  known_names = {netid: d["displayname"] for netid, d in sponsor_dicts.items()}
+  user_sponsor["sponsor-dict"] = user_sponsor.netid.apply(lambda netid: sponsor_dicts[netid])
 
   # perform a two-column groupby (cluster-partition and netid) and then join users to their sponsors
   dg = groupby_cluster_partition_netid_and_get_sponsor(df, user_sponsor)
   _ = check_for_nulls(dg)
 
   # compute cpu and gpu efficiencies when possible
-  user_eff = compute_cpu_and_gpu_efficiencies(df, clusparts)
+  eff_cache = effcache.EfficiencyCache(f"{args.basepath}/cache/efficiency.sqlite")
+  user_eff = compute_cpu_and_gpu_efficiencies(df, clusparts, admincomment, cache=eff_cache)
+  eff_cache.close()
+  del admincomment
 
   dg = pd.merge(dg, user_eff, how="left", on=["cluster-partition", "netid"])
   dg[["CPU-eff", "GPU-eff"]] = dg[["CPU-eff", "GPU-eff"]].fillna("--")
@@ -497,8 +1008,11 @@ if __name__ == "__main__":
     if os.path.exists(brakefile):
       seconds_since_emails_last_sent = datetime.now().timestamp() - os.path.getmtime(brakefile)
       assert seconds_since_emails_last_sent > 7 * HOURS_PER_DAY * SECONDS_PER_HOUR, "Emails sent within last 7 days"
-  with open(brakefile, "w") as f:
-    f.write("")
+  else:
+    # with --email the brakefile is only written when the first email is sent (see send below)
+    # so that a run that fails before sending can be repeated
+    with open(brakefile, "w") as f:
+      f.write("")
 
   # write dataframe to file for archiving
   cols = ["cluster", "sponsor", "netid", "name", "cpu-hours", "CPU-eff", "CPU-rank", "gpu-hours", "GPU-eff", "GPU-rank", \
@@ -507,15 +1021,8 @@ if __name__ == "__main__":
     fname = f"{args.basepath}/archive/cluster_sponsor_user_{start_date.strftime('%-d%b%Y')}_{end_date.strftime('%-d%b%Y')}.csv"
     dg[cols].to_csv(fname, index=False)
 
-  # create reports (each sponsor is guaranteed to have at least one user by construction above)
-  cols1 = ["cluster", "partition", "cluster-partition", "cpu-hours", "CPU-rank", "CPU-eff", \
-           "gpu-hours", "GPU-rank", "GPU-eff", "jobs", "account", "sponsor"]
-  cols2 = ["netid", "name", "cpu-hours", "gpu-hours", "jobs", "account", "partition"]
-  cols3 = ["cluster", "netid", "partition", "cpu-hours", "CPU-rank", "CPU-eff", "gpu-hours", \
-           "GPU-rank", "GPU-eff", "jobs", "cluster-partition"]
-  renamings = {"netid":"NetID", "name":"Name", "cpu-hours":"CPU-hours", "gpu-hours":"GPU-hours", \
-               "jobs":"Jobs", "account":"Account", "partition":"Partition", "cluster":"Cluster", \
-               "sponsor":"Sponsor"}
+  # create reports (each sponsor is guaranteed to have at least one user by construction above).
+  # the tables are made by sponsor_cluster_table, details_table, projects_table and user_table.
   # next two lines throw away null sponsors and null users (which are revealed above in output)
   sponsors = dg[pd.notnull(dg.sponsor)].sponsor.sort_values().unique()
   users    = dg[pd.notnull(dg.netid)].netid.sort_values().unique()
@@ -528,217 +1035,80 @@ if __name__ == "__main__":
   ###########
   import filesets as fs
   from DataStorage import DataStorage
-  block_usage = DataStorage("gpfs_quota_block_usage_bytes")
-  block_limit = DataStorage("gpfs_quota_block_limit_hard_bytes")
-  files_usage = DataStorage("gpfs_quota_files_usage")
-  files_limit = DataStorage("gpfs_quota_files_limit_hard")
-  # uids
-  uid_user = pd.read_csv("master.uids",
-                         names=["uid", "username"],
-                         dtype={"uid": str, "username": str})
-  uid_user.dropna(inplace=True)
-  uid_user = uid_user[uid_user.uid != "0"]
-  uid2user = dict(zip(uid_user.uid.values, uid_user.username.values))
-  user2uid = dict(zip(uid_user.username.values, uid_user.uid.values))
-  with open("tigress_user_changes_josko_1oct2024.log") as f:
-      lines = f.readlines()
-  older = {"0": "root"}
-  older_inverse = {"root": 0}
-  for line in lines:
-      if "- Added user " in line and line.count("(") > 1:
-          uid = line.split("(")[1].split()[0]
-          netid = line.split("(")[0].strip().split()[-1]
-          older[uid] = netid
-          older_inverse[netid] = uid
-   
+  import snapshots
+  # one Prometheus query for the four quota metrics
+  quotas = DataStorage.fetch(["gpfs_quota_block_usage_bytes", "gpfs_quota_block_limit_hard_bytes",
+                              "gpfs_quota_files_usage", "gpfs_quota_files_limit_hard"])
+  block_usage = quotas["gpfs_quota_block_usage_bytes"]
+  block_limit = quotas["gpfs_quota_block_limit_hard_bytes"]
+  files_usage = quotas["gpfs_quota_files_usage"]
+  files_limit = quotas["gpfs_quota_files_limit_hard"]
+  # keep the quotas of the day for the usage history (see snapshots.py). dry runs leave no
+  # snapshot (missing days are filled with snapshots.py --backfill-days)
+  if args.email: snapshots.write_snapshot(f"{args.basepath}/storage", date.today(), block_usage.table)
+  # uids (master.uids first and then the log of user changes)
+  ids = identity.IdentityIndex(f"{args.basepath}/cache/identity.json", log="tigress_user_changes_josko_1oct2024.log").refresh()
+  ids.save()
+  # /projects usage per fileset with the netids of the uids (looked up once for all sponsors)
+  projects_index = block_usage.fileset_index(ids.netid)
 
   if args.report_type == "users":
     assert datetime.now().strftime("%-d") == "15", "Script will only run on 15th of the month"
     # remove unsubscribed users and those that left the university
     unsubscribed_users = ["bfaber", "ceerc", "sting", "ib4025", "mchitoto", "musslick"]
-    users = set(users) - set(unsubscribed_users)
-    for user in sorted(users):
-      sp = dg[dg.netid == user]
-      rows = pd.DataFrame()
-      if args.email: print(f"User: {user}")
-      for cluspart in clusparts:
-        cl = sp[sp["cluster-partition"] == cluspart].copy()
-        if not cl.empty:
-          rows = pd.concat([rows, cl[cols1].rename(columns=renamings)])
-      rows["GPU-hours"] = rows.apply(lambda row: row["GPU-hours"] if row["cluster-partition"] in GPU_CLUSTER_PARTITIONS else "N/A", axis="columns")
-      rows["GPU-eff"]   = rows.apply(lambda row: row["GPU-eff"]   if row["cluster-partition"] in GPU_CLUSTER_PARTITIONS else "N/A", axis="columns")
-      rows["GPU-eff"]   = rows.apply(lambda row: row["GPU-eff"]   if row["Partition"] != "mig" else "--", axis="columns")
-      if (rows[rows["cluster-partition"].isin(GPU_CLUSTER_PARTITIONS)].shape[0] == 0):
-        rows.drop(columns=["GPU-hours", "GPU-rank", "GPU-eff"], inplace=True)
-      rows.drop(columns=["cluster-partition"], inplace=True)
-      body = "\n".join([2 * " " + row for row in rows.to_string(index=False, justify="center").split("\n")])
-      body += "\n\n"
-      report = create_user_report(get_full_name_from_ldap(user), user, start_date, end_date, body)
-      print(report)
-      if args.email: send_email(report, f"{user}@princeton.edu", start_date, end_date)
-      if args.email and random() < 0.01: send_email(report, "halverson@princeton.edu", start_date, end_date)
+    users = sorted(set(users) - set(unsubscribed_users))
+    user_names = ldapcache.get_full_names(ldap_cache, users, known_names, verbose=True, workers=args.workers)
+    # one row per cluster-partition of each user (in the order of the cluster-partitions)
+    user_plan = report_plan(dg[dg["cluster-partition"].isin(clusparts)], "netid", sort_by="cluster-partition")
+    tasks = [(user, user_names[user], user_plan[user], start_date, end_date) for user in users]
+    func, recipients, label, copy_rate = render_user_report, users, "User", 0.01
   elif args.report_type == "sponsors":
     assert datetime.now().strftime("%-d") == "1", "Script will only run on 1st of the month"
     ov = collapse_by_sponsor(dg)
+    summary = sponsor_summary(ov)
+    sponsor_plan = report_plan(ov, "sponsor")
+    details_plan = report_plan(dg, "sponsor")
     # remove unsubscribed sponsors and those that left the university
     unsubscribed_sponsors = ["aturing", "mzaletel"]
-    sponsors = set(sponsors) - set(unsubscribed_sponsors)
-    for sponsor in sorted(sponsors):
-      sp = ov[ov.sponsor == sponsor]
-      body = ""
-      if args.email: print(f"Sponsor: {sponsor}")
-      for cluster in ("della", "stellar", "tiger", "traverse"):
-        cl = sp[sp.cluster == cluster]
-        if not cl.empty:
-          # determine where a group ranks relative to other groups
-          cpu_hours_by_sponsor = cl["cpu-hours"].sum()
-          gpu_hours_by_sponsor = cl["gpu-hours"].sum()
-          cpu_hours_total = ov[ov.cluster == cluster]["cpu-hours"].sum()
-          gpu_hours_total = ov[ov.cluster == cluster]["gpu-hours"].sum()
-          cpu_hours_pct = 0 if cpu_hours_total == 0 else format_percent(100 * cpu_hours_by_sponsor / cpu_hours_total)
-          gpu_hours_pct = 0 if gpu_hours_total == 0 else format_percent(100 * gpu_hours_by_sponsor / gpu_hours_total)
-          cpu_hours_rank  = ov[ov.cluster == cluster].groupby("sponsor").agg({"cpu-hours":np.sum}).sort_values(by="cpu-hours", ascending=False).index.get_loc(sponsor) + 1
-          gpu_hours_rank  = ov[ov.cluster == cluster].groupby("sponsor").agg({"gpu-hours":np.sum}).sort_values(by="gpu-hours", ascending=False).index.get_loc(sponsor) + 1
-          total_sponsors  = ov[ov.cluster == cluster]["sponsor"].unique().size
-          if cpu_hours_by_sponsor == 0:
-            cpu_hours_rank = total_sponsors
-          if gpu_hours_by_sponsor == 0:
-            gpu_hours_rank = total_sponsors
-
-          cl = add_proportion_in_parenthesis(cl.copy(), "cpu-hours", replace=True)
-          cl["account"] = cl["account"].apply(lambda x: uniq_series(x.split(",")))
-          body += "\n"
-          body += add_heading(cl[cols2].rename(columns=renamings).to_string(index=False, justify="center"), cluster)
-          body += special_requests(sponsor, cluster, cl, start_date, end_date)
-          body += f"\n\nYour group used {cpu_hours_by_sponsor} CPU-hours or {cpu_hours_pct}% of the {cpu_hours_total} total CPU-hours"
-          body += f"\non {cluster[0].upper() + cluster[1:]}. Your group is ranked {cpu_hours_rank} of {total_sponsors} by CPU-hours used."
-          if gpu_hours_by_sponsor != 0:
-            body +=  " Similarly,"
-            body += f"\nyour group used {gpu_hours_by_sponsor} GPU-hours or {gpu_hours_pct}% of the {gpu_hours_total} total GPU-hours"
-            body += f"\nwhich yields a ranking of {gpu_hours_rank} of {total_sponsors} by GPU-hours used."
-          body += "\n\n"
-
-      # details dataframe
-      details = dg[dg.sponsor == sponsor][cols3].rename(columns=renamings).sort_values(["Cluster", "NetID", "Partition"])
-      details["GPU-hours"] = details.apply(lambda row: row["GPU-hours"] if row["cluster-partition"] in GPU_CLUSTER_PARTITIONS else "N/A", axis="columns")
-      details["GPU-rank"]  = details.apply(lambda row: row["GPU-rank"]  if row["cluster-partition"] in GPU_CLUSTER_PARTITIONS else "N/A", axis="columns")
-      details["GPU-eff"]   = details.apply(lambda row: row["GPU-eff"]   if row["cluster-partition"] in GPU_CLUSTER_PARTITIONS else "N/A", axis="columns")
-      details["GPU-eff"]   = details.apply(lambda row: row["GPU-eff"]   if row["Partition"] != "mig" else "--", axis="columns")
-      if (details[details["cluster-partition"].isin(GPU_CLUSTER_PARTITIONS)].shape[0] == 0):
-        details.drop(columns=["GPU-hours", "GPU-rank", "GPU-eff"], inplace=True)
-      details.drop(columns=["cluster-partition"], inplace=True)
-      details["Cluster"] = details["Cluster"].apply(lambda x: f"{x[0].upper()}{x[1:]}")
-      df_str = details.to_string(index=False, justify="center")
-      max_width = max(map(len, df_str.split("\n")))
-      heading = "Detailed Breakdown"
-      padding = " " * max(1, math.ceil((max_width - len(heading)) / 2))
-      body += "\n"
-      body += padding + heading + padding + "\n"
-      body += "-" * max_width + "\n"
-      for i, line in enumerate(df_str.split("\n")):
-        body += line + "\n"
-        if i == 0: body += "-" * max_width + "\n"
-      body += "\n"
-
-      ###########
-      # storage #
-      ###########
-      def base2to10(x):
-          if x < 1024:
-              return f"{x} B"
-          elif x < 1024**2:
-              return f"{round(x / 1024)} KB"
-          elif x < 1024**3:
-              return f"{round(x / 1024**2)} MB"
-          elif x < 1024**4:
-              return f"{round(x / 1024**3)} GB"
-          elif x < 1024**5:
-              return f"{round(x / 1024**4)} TB"
-          elif x < 1024**6:
-              return f"{round(x / 1024**5)} PB"
-         
-      def extract_proportion(x):
-          if isinstance(x, int):
-              return "(100%)"
-          return x.split()[1]
-
-      def combine_amount_proportion(amt, pro):
-          if pro == "(100%)":
-              return f"{amt} {pro}"
-          mylen = len(pro)
-          pro = " " * (6 - mylen) + pro
-          return amt + pro
-
-      # /scratch/gpfs
-      for cluster in ("della", "stellar", "tiger"):
-          cl = sp[sp.cluster == cluster]
-          if not cl.empty:
-              st = []
-              for n in cl.netid:
-                  uid = None
-                  if n in user2uid:
-                      uid = user2uid[n]
-                  elif n in older_inverse:
-                      uid = older_inverse[n]
-                  #else exit
-                  key = f"{cluster}.gpfs.root"
-                  #print(cluster, n, uid, key)
-                  if uid and key in block_usage.d[uid]:
-                      amount = block_usage.d[uid][key]
-                      if amount:
-                          st.append([netid, uid, amount])
-              if st:
-                  pass
- 
-
-      # /projects2
-      if sponsor in fs.filesets:
-          not_shown_yet = True
-          for myfs in fs.filesets[sponsor]:
-              st = []
-              for uid in block_usage.d:
-                  if uid == myfs:
-                      continue
-                  key = f"projects2.storage.{myfs}"
-                  if key in block_usage.d[uid]:
-                      netid = "UNKNOWN"
-                      if uid in uid2user:
-                          netid = uid2user[uid]
-                      elif uid in older:
-                          netid = older[uid]
-                      amount = block_usage.d[uid][key]
-                      if amount:
-                          st.append([netid, uid, amount])
-              if st:
-                  if not_shown_yet:
-                      body += "\n" + "We are beginning to include storage information in these reports. Below is \nyour accounting for /projects as of today:\n\n"
-                      not_shown_yet = False
-                  st = pd.DataFrame(st, columns=["NetID", "UID", "Amount2"])
-                  st.sort_values("Amount2", ascending=False, inplace=True)
-                  st["base10"] = st.Amount2.apply(base2to10)
-                  st = add_proportion_in_parenthesis(st.copy(), "Amount2", replace=True)
-                  st["proportion"] = st["Amount2"].apply(extract_proportion)
-                  st["    Amount    "] = st.apply(lambda row: combine_amount_proportion(row["base10"], row["proportion"]), axis="columns")
-                  cols = ["NetID", "UID", "    Amount    "]
-                  st_str = st[cols].to_string(index=False, justify="center")
-                  max_width = max(map(len, st_str.split("\n")))
-                  heading = f"/projects/{myfs}"
-                  padding = " " * max(1, math.ceil((max_width - len(heading)) / 2))
-                  body += "\n"
-                  body += padding + heading + padding + "\n"
-                  body += "-" * max_width + "\n"
-                  for i, line in enumerate(st_str.split("\n")):
-                      body += line + "\n"
-                      if i == 0: body += "-" * max_width + "\n"
-                  body += "\n"
- 
-      # create report
-      name = get_full_name_from_ldap(sponsor, verbose=True)
-      report = create_report(name, sponsor, start_date, end_date, body)
-      print(report)
-
-      if args.email:
-        send_email(report, f"{sponsor}@princeton.edu", start_date, end_date)
-        if random() < 0.025: send_email(report, "halverson@princeton.edu", start_date, end_date)
+    sponsors = sorted(set(sponsors) - set(unsubscribed_sponsors))
+    sponsor_names = ldapcache.get_full_names(ldap_cache, sponsors, known_names, verbose=True, workers=args.workers)
+    tasks = []
+    for sponsor in sponsors:
+      sp = sponsor_plan[sponsor]
+      _, projects = sponsor_storage(sponsor, sp, block_usage.d, ids, fs.filesets, projects_index)
+      tasks.append((sponsor, sponsor_names[sponsor], sp, details_plan[sponsor], summary.xs(sponsor, level="sponsor"),
+                    projects, start_date, end_date))
+    func, recipients, label, copy_rate = render_sponsor_report, sponsors, "Sponsor", 0.025
   else:
     sys.exit("Error: report_type does not match choices.")
+
+  # the reports are printed (and spooled) in order while sender threads email them
+  def consume(i, report):
+    recipient = recipients[i]
+    if args.email: print(f"{label}: {recipient}")
+    print(report)
+    addressees = [f"{recipient}@princeton.edu"] + (["halverson@princeton.edu"] if random() < copy_rate else [])
+    if args.spool:
+      outbox.write(i, recipient, report, addressees)
+      return []
+    return addressees if args.email else []
+  brake, braked = threading.Lock(), []
+  def send(report, addressee):
+    with brake:
+      if not braked:
+        with open(brakefile, "w") as f:
+          f.write("")
+        braked.append(True)
+    send_email(report, addressee, start_date, end_date, smtp=smtp)
+  if args.spool: outbox.clear()
+  pipeline_reports(render_reports(func, tasks, workers=args.processes), consume, send, senders=args.senders)
+
+  # send the spooled reports over the same sender threads and SMTP connections (each email
+  # is journaled so that --resume continues from here)
+  if args.spool:
+    outbox.finish(report_type=args.report_type, start=start_date.isoformat(), end=end_date.isoformat())
+    print(f"Spooled {len(outbox.files())} reports in {outbox.path}")
+    if args.email:
+      outbox.drain(send, senders=args.senders)
+  smtp.close()
+  if args.email: print(f"Sent {smtp.sent} emails ({smtp.reconnects} reconnects).")
@@ -0,0 +1,74 @@
+import math
+
+# The tables of the reports were made with DataFrame.to_string(index=False, justify="center").
+# The functions below produce the same text from plain lists: each value is formatted
+# without a leading space, right-justified to the widest value of its column and then
+# centered under the header. Headers of numeric columns have a leading space. Columns are
+# separated by one space.
+
+
+def format_value(x):
+  if x is None: return "None"
+  if isinstance(x, float) and x != x: return "NaN"
+  return str(x)
+
+def is_integer(x):
+  return hasattr(x, "__index__") and not isinstance(x, bool)
+
+def render_column(header, values, numeric):
+  """Return the header and the values of one column as strings of equal width."""
+  values = [f"{int(x):d}" for x in values] if numeric else [format_value(x) for x in values]
+  width = max(map(len, values))
+  values = [x.rjust(width) for x in values]
+  header = " " + header if numeric else header
+  width = max(width, len(header))
+  values = [x.center(width) for x in values]
+  return [header.center(width)] + values
+
+def render_table(headers, columns, numeric=None):
+  """Return the text of the table with the given headers and columns (lists of values).
+     A column is numeric (as for an int64 column of a dataframe) when all of its values
+     are integers unless numeric (list of booleans) is given."""
+  if numeric is None: numeric = [all(map(is_integer, column)) for column in columns]
+  rendered = [render_column(h, c, n) for h, c, n in zip(headers, columns, numeric)]
+  widths = [max(map(len, col)) + 1 for col in rendered[:-1]] + [max(map(len, rendered[-1]))]
+  return "\n".join("".join(x.ljust(w) for x, w in zip(line, widths)) for line in zip(*rendered))
+
+def proportions(values):
+  """Return the values as "amount (percent%)" strings with the opening parentheses aligned
+     and whether the values are still numbers, which is the case for a single value or a
+     total of zero."""
+  total = sum(values)
+  if len(values) == 1 or total == 0: return list(values), True
+  items = [f"{round(x)} ({round(100 * float(x) / float(total))}%)" for x in values]
+  widths = [item.index(")") - item.index("(") for item in items]
+  max_chars = max(widths)
+  items = [item[:item.index("(")] + " " * (max_chars - w) + item[item.index("("):] for item, w in zip(items, widths)]
+  return items, False
+
+def mask(values, keep, other):
+  return [x if k else other for x, k in zip(values, keep)]
+
+def add_heading(table, title):
+  """Add the title (centered) between dividers above the table and a divider after the header."""
+  rows = table.split("\n")
+  width = max([len(row) for row in rows])
+  padding = " " * max(1, math.ceil((width - len(title)) / 2))
+  divider = padding + title[0].upper() + title[1:] + padding
+  rows.insert(0, divider)
+  rows.insert(1, "-" * len(divider))
+  rows.insert(3, "-" * len(divider))
+  return "\n".join(rows)
+
+def add_divided_heading(table, heading):
+  """Add the heading above the table with dividers that span the table (detailed breakdown
+     and /projects tables). The text ends with a blank line."""
+  lines = table.split("\n")
+  max_width = max(map(len, lines))
+  padding = " " * max(1, math.ceil((max_width - len(heading)) / 2))
+  text = padding + heading + padding + "\n"
+  text += "-" * max_width + "\n"
+  for i, line in enumerate(lines):
+    text += line + "\n"
+    if i == 0: text += "-" * max_width + "\n"
+  return text + "\n"
@@ -0,0 +1,176 @@
+"""Date-partitioned store of the GPFS quota table (see DataStorage.quota_table)
+   with one file per day. The sponsor reports add the snapshot of the day and
+   older days are backfilled from Prometheus with query_range. The usage
+   history and the change over a period per fileset or per uid are then read
+   from local disk."""
+import os
+import argparse
+from datetime import date
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+import pandas as pd
+import jobcache
+from DataStorage import DataStorage
+from DataStorage import QUOTA_FIELDS
+from DataStorage import query_expression
+from DataStorage import quota_table
+
+# snapshots in feather are filtered with pyarrow before they are converted
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import feather
+except ImportError:
+    pc = None
+
+SECONDS_PER_DAY = 86400
+
+
+def snapshot_path(store, day):
+    return os.path.join(store, f"{day.isoformat()}.{jobcache.FORMAT}")
+
+
+def write_snapshot(store, day, table):
+    """Write (or replace) the quota table of the day."""
+    os.makedirs(store, exist_ok=True)
+    jobcache.write_frame(table, snapshot_path(store, day))
+
+
+def read_snapshot(store, day, columns=None, key=None, owner=None):
+    """Return the quota table of the day (optionally some columns and the rows
+       of one key or owner) with the owner and key as strings. With feather
+       the rows are selected before the conversion to a dataframe."""
+    fname = snapshot_path(store, day)
+    if pc is None or not fname.endswith(".feather"):
+        table = jobcache.read_frame(fname, columns=columns)
+        if key is not None: table = table[table.key == key]
+        if owner is not None: table = table[table.owner == owner]
+        return table.astype({name: str for name in ("owner", "key") if name in table.columns})
+    table = feather.read_table(fname, columns=columns)
+    if key is not None: table = table.filter(pc.equal(table["key"], key))
+    if owner is not None: table = table.filter(pc.equal(table["owner"], owner))
+    decoded = [column.cast(pa.string()) if pa.types.is_dictionary(column.type) else column for column in table.columns]
+    return pa.table(decoded, names=table.column_names).to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+
+def snapshot_dates(store, start=date.min, end=date.max):
+    """Return the sorted days from start to end that have a snapshot."""
+    if not os.path.isdir(store):
+        return []
+    days = []
+    for fname in os.listdir(store):
+        stem, ext = os.path.splitext(fname)
+        if ext != f".{jobcache.FORMAT}":
+            continue
+        try:
+            day = date.fromisoformat(stem)
+        except ValueError:
+            continue  # not a snapshot (e.g., a copy of one)
+        if start <= day <= end:
+            days.append(day)
+    return sorted(days)
+
+
+def split_range_response(response):
+    """Return a dictionary of day to an instant query response (as read by
+       quota_table) from a query_range response. The last sample of a day is
+       used if a series has more than one."""
+    days = {}
+    for res in response["data"]["result"]:
+        last = {}
+        for t, value in res["values"]:
+            last[datetime.fromtimestamp(float(t)).date()] = [t, value]
+        for day, value in last.items():
+            days.setdefault(day, []).append({"metric": res["metric"], "value": value})
+    return {day: {"data": {"result": result}} for day, result in days.items()}
+
+
+def backfill(store, start, end, fields=QUOTA_FIELDS, chunk_days=30, hour=9, overwrite=False, query=None):
+    """Write the snapshots of the days from start to end that are missing (all
+       of them with overwrite) using one query_range call per chunk_days days
+       and one sample per day at the given hour. query(params) returns the
+       response (DataStorage.query_range by default). Returns the days written."""
+    query = query or DataStorage.query_range
+    have = set(snapshot_dates(store, start, end))
+    written = []
+    first = start
+    while first <= end:
+        last = min(first + timedelta(days=chunk_days - 1), end)
+        missing = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+        missing = [day for day in missing if overwrite or day not in have]
+        if missing:
+            params = {"query": query_expression(fields),
+                      "start": datetime.combine(missing[0], time(hour)).timestamp(),
+                      "end": datetime.combine(missing[-1], time(hour)).timestamp(),
+                      "step": SECONDS_PER_DAY}
+            for day, response in sorted(split_range_response(query(params)).items()):
+                if day in missing:
+                    write_snapshot(store, day, quota_table(response, fields))
+                    written.append(day)
+        first = last + timedelta(days=1)
+    return written
+
+
+def history(store, start, end, field="gpfs_quota_block_usage_bytes", key=None, owner=None, group=("owner", "key")):
+    """Return the values of the field per day and group (summed over the other
+       owners and keys) from start to end, optionally for one key (e.g.,
+       projects2.storage.WEBB) or one owner (uid or fileset name)."""
+    group = list(group)
+    frames = []
+    for day in snapshot_dates(store, start, end):
+        table = read_snapshot(store, day, columns=["owner", "key", field], key=key, owner=owner)
+        table = table[table[field].notna()]
+        values = table.groupby(group, sort=False)[field].sum().reset_index()
+        values.insert(0, "date", day)
+        frames.append(values)
+    if not frames:
+        return pd.DataFrame(columns=["date"] + group + [field])
+    return pd.concat(frames, ignore_index=True)
+
+
+def deltas(store, start, end, field="gpfs_quota_block_usage_bytes", key=None, owner=None, group=("owner", "key")):
+    """Return the value of the field per group in the first and the last
+       snapshot from start to end and the change (a group that is missing
+       from one of the snapshots counts as 0) sorted from the largest increase."""
+    group = list(group)
+    days = snapshot_dates(store, start, end)
+    if not days:
+        return pd.DataFrame(columns=group + ["first", "last", "change"])
+    values = history(store, days[0], days[0], field, key, owner, group).set_index(group)[field].rename("first")
+    if days[-1] != days[0]:
+        later = history(store, days[-1], days[-1], field, key, owner, group).set_index(group)[field].rename("last")
+    else:
+        later = values.rename("last")
+    table = pd.concat([values, later], axis="columns").fillna(0).astype("int64")
+    table["change"] = table["last"] - table["first"]
+    table = table.sort_values("change", ascending=False, kind="mergesort").reset_index()
+    table.attrs["first"], table.attrs["last"] = days[0], days[-1]
+    return table
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Snapshots of the GPFS quotas for the monthly reports')
+    parser.add_argument('--basepath', required=True, type=str, metavar='PATH',
+                        help='Specify the path to monthly_sponsor_reports.py')
+    parser.add_argument('--backfill-days', type=int, default=0, metavar='N',
+                        help='Fill the missing snapshots of the past N days from Prometheus (default: 0)')
+    parser.add_argument('--fileset', type=str, default=None, metavar='KEY',
+                        help='Show the change in usage per uid of KEY (e.g., projects2.storage.WEBB)')
+    parser.add_argument('--days', type=int, default=90, metavar='N',
+                        help='Period of --fileset in days (default: 90)')
+    args = parser.parse_args()
+
+    store = f"{args.basepath}/storage"
+    today = date.today()
+    if args.backfill_days:
+        written = backfill(store, today - timedelta(days=args.backfill_days), today - timedelta(days=1))
+        print(f"Wrote {len(written)} snapshots to {store}.")
+    if args.fileset:
+        table = deltas(store, today - timedelta(days=args.days), today, key=args.fileset)
+        if table.empty:
+            print(f"No snapshots in {store}.")
+        else:
+            print(f"Change in usage of {args.fileset} from {table.attrs['first']} to {table.attrs['last']} (bytes):")
+            print(table.to_string(index=False))
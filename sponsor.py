@@ -1,23 +1,65 @@
 import os
+import time
 import subprocess
 import pandas as pd
+import identity
 import base64
 import unicodedata
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 
 def strip_accents(s):
     return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
 
 
+RC_LDAP = "ldap://ldap01.rc.princeton.edu"
+RC_BASE = "dc=rc,dc=princeton,dc=edu"
+
+
+def run_ldap_lookups(lookup, items, workers=8, retries=2, backoff=1.0, verbose=True):
+    """Call lookup(item) for each item on a pool of at most workers threads
+       so that the directory server never sees more than workers concurrent
+       ldapsearch processes. A lookup that fails or times out is retried up to
+       retries times after waiting backoff, 2 * backoff, ... seconds. Returns
+       a dictionary of item to result for the successful lookups and a
+       dictionary of item to the last error for the failed ones (which are
+       summarized when verbose)."""
+    def attempt(item):
+        for i in range(retries + 1):
+            try:
+                return lookup(item), None
+            except (subprocess.SubprocessError, OSError) as error:
+                last_error = error
+                if i < retries: time.sleep(backoff * 2**i)
+        return None, last_error
+    items = list(items)
+    results, failures = {}, {}
+    if items:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(items)))) as executor:
+            for item, (result, error) in zip(items, executor.map(attempt, items)):
+                if error is None:
+                    results[item] = result
+                else:
+                    failures[item] = error
+    if failures and verbose:
+        print(f"W: {len(failures)} of {len(items)} LDAP lookups failed after {retries} retries:")
+        for item, error in failures.items():
+            print(f"   {item}: {error}")
+    return results, failures
+
+
 def get_sponsor_netid_per_cluster_dict_from_ldap(netid, verbose=True, strip=False):
   """Returns a dictionary of sponsor netids for a given user netid for the large clusters."""
-  ldap = "ldap://ldap01.rc.princeton.edu"
-  cmd = f"ldapsearch -x -H {ldap} -b dc=rc,dc=princeton,dc=edu uid={netid} displayname manager description"
+  cmd = f"ldapsearch -x -H {RC_LDAP} -b {RC_BASE} uid={netid} displayname manager description"
   output = subprocess.run(cmd, stdout=subprocess.PIPE, shell=True, timeout=5, text=True, check=True)
   lines = output.stdout.split('\n')
   if lines != [] and lines[-1] == "": lines = lines[:-1]
-  
+  return sponsor_dict_from_ldif_lines(netid, lines, verbose=verbose, strip=strip)
+
+
+def sponsor_dict_from_ldif_lines(netid, lines, verbose=True, strip=False):
+  """Returns the dictionary of sponsor netids of a user from the LDIF lines of its entry."""
   # get primary manager (if more than 1 then take first)
   line_index = 0
   displayname = None
@@ -35,13 +77,11 @@ def get_sponsor_netid_per_cluster_dict_from_ldap(netid, verbose=True, strip=Fals
   if managers == []:
     primary = None
     # try looking in CSV file if available
-    fname = "users_left_university_from_robert_knight.csv"
-    if os.path.exists(fname):
-      rk = pd.read_csv(fname)
-      if not rk[rk.Netid_ == netid].empty:
-        primary = rk[rk.Netid_ == netid].Sponsor_Netid_.values[0]
-        if not displayname: displayname = rk[rk.Netid_ == netid].Name_.values[0]
-        if verbose: print(f"W: Primary sponsor for {netid} taken from CSV file.")
+    departed = identity.get_index(log=None, departed="users_left_university_from_robert_knight.csv").departed_user(netid)
+    if departed:
+      primary = departed[0]
+      if not displayname: displayname = departed[1]
+      if verbose: print(f"W: Primary sponsor for {netid} taken from CSV file.")
     if not primary and verbose: print(f"W: No primary sponsor found for {netid} in CSES LDAP or CSV file.")
   elif len(managers) > 1:
     if verbose:
@@ -78,14 +118,65 @@ def get_sponsor_netid_per_cluster_dict_from_ldap(netid, verbose=True, strip=Fals
   return sponsor
 
 
-def get_full_name_from_ldap(netid, use_rc=False, include_netid=False, verbose=True, strip=True):
+def split_ldif_entries(ldif):
+    """Return a dictionary of uid to the lines of the LDIF entries of that uid
+       (as from ldapsearch). Comments and search results are dropped while
+       continuation lines are kept as is."""
+    entries = {}
+    for block in ldif.split("\n\n"):
+        lines = [line for line in block.split("\n") if line and not line.startswith("#")]
+        if lines and lines[0].startswith("dn: uid="):
+            uid = lines[0][len("dn: uid="):].split(",")[0].strip()
+            entries.setdefault(uid, []).extend(lines)
+    return entries
+
+
+def sponsor_dicts_from_ldif(netids, ldif, verbose=True, strip=False):
+    """Return a dictionary of netid to the sponsor dictionary (see
+       get_sponsor_netid_per_cluster_dict_from_ldap) using LDIF that
+       contains the entries of all of the netids."""
+    entries = split_ldif_entries(ldif)
+    return {netid: sponsor_dict_from_ldif_lines(netid, entries.get(netid, []), verbose=verbose, strip=strip)
+            for netid in netids}
+
+
+def get_sponsor_netid_per_cluster_dicts_from_ldap(netids, verbose=True, strip=False, chunksize=100, timeout=5, workers=4, retries=2):
+    """Batched version of get_sponsor_netid_per_cluster_dict_from_ldap. The
+       netids are looked up with OR filters of chunksize netids. The filters
+       are spread over at most workers concurrent ldapsearch processes (one
+       connection each) that read them from stdin and the LDIF is parsed once.
+       Returns a dictionary of netid to the sponsor dictionary where the
+       netids of failed searches (see run_ldap_lookups) are left out."""
+    netids = list(dict.fromkeys(netids))
+    valid = [netid for netid in netids if re.fullmatch(r"[\w.-]+", netid)]
+    filters = ["(|" + "".join(f"(uid={netid})" for netid in valid[i:i + chunksize]) + ")"
+               for i in range(0, len(valid), chunksize)]
+    groups = [tuple(filters[i::workers]) for i in range(min(workers, len(filters)))]
+    def search(group):
+        cmd = ["ldapsearch", "-x", "-H", RC_LDAP, "-b", RC_BASE, "-f", "-", "%s", "displayname", "manager", "description"]
+        output = subprocess.run(cmd,
+                                input="\n".join(group) + "\n",
+                                stdout=subprocess.PIPE,
+                                timeout=timeout * len(group),
+                                text=True,
+                                check=True)
+        return output.stdout
+    ldif, failures = run_ldap_lookups(search, groups, workers=workers, retries=retries, verbose=False)
+    failed = {netid for group in failures for f in group for netid in re.findall(r"\(uid=([^)]+)\)", f)}
+    if failed and verbose:
+        print(f"W: Sponsor lookup failed for {len(failed)} users: {failures[next(iter(failures))]}")
+    resolved = [netid for netid in netids if netid not in failed]
+    return sponsor_dicts_from_ldif(resolved, "\n\n".join(ldif.values()), verbose=verbose, strip=strip)
+
+
+def get_full_name_from_ldap(netid, use_rc=False, include_netid=False, verbose=True, strip=True, timeout=5):
   """Return the full name for the given netid by using either rc or university ldap."""
   if use_rc:
     ldap = "ldap://ldap01.rc.princeton.edu"
     cmd = f"ldapsearch -x -H {ldap} -b dc=rc,dc=princeton,dc=edu uid={netid} displayname"
   else:
     cmd = f"ldapsearch -x uid={netid} displayname"
-  output = subprocess.run(cmd, stdout=subprocess.PIPE, shell=True, timeout=5, text=True, check=True)
+  output = subprocess.run(cmd, stdout=subprocess.PIPE, shell=True, timeout=timeout, text=True, check=True)
   lines = output.stdout.split('\n')
   displayname = None
   for line in lines:
@@ -103,77 +194,46 @@ def get_full_name_from_ldap(netid, use_rc=False, include_netid=False, verbose=Tr
 
 
 def get_full_name_of_user_from_log(netid, flnm="tigress_user_changes.log"):
-    """Return the full name of the user from the log file. Loop over all
-       lines (i.e., do not return on first match)."""
-    with open(flnm, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-    pattern = f" {netid} "
-    logname = None
-    for line in lines:
-        if pattern in line:
-            if f" Added user {netid} (" in line:
-                logname = line.split(f" Added user {netid} (")[-1].split(")")[0].split(" - ")[-1]
-            if f" Removed user {netid} (" in line:
-                logname = line.split(f" Removed user {netid} (")[-1].split(")")[0]
-    return logname
+    """Return the full name of the user from the log file. The last matching
+       line wins (see identity.IdentityIndex)."""
+    return identity.get_index(log=flnm).name(netid)
 
 
 def get_sponsor_netid_of_user_from_log(netid, flnm="tigress_user_changes.log"):
     """Return the sponsor netid for a given user netid from the log file.
-       Loop over all lines (i.e., do not return on first match)."""
-    with open(flnm, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-    pattern = f" {netid} "
-    sponsor = None
-    for line in lines:
-        if pattern in line:
-            if f" Added user {netid} " in line and " with sponsor " in line:
-                sponsor = line.split(" with sponsor ")[-1].split()[0]
-            if f" Removed user {netid} " in line and " sponsor " in line:
-                sponsor = line.split(" sponsor ")[-1].split(";")[0]
-    return sponsor
-
-
-def build_uid_username_dictionaries(uids: set[str], flnm="tigress_user_changes.log"):
+       The last matching line wins (see identity.IdentityIndex)."""
+    return identity.get_index(log=flnm).sponsor(netid)
+
+
+def build_uid_username_dictionaries(uids: set[str], flnm="tigress_user_changes.log", workers=8):
     """Return a uid-to-username and username-to-uid dictionary for a given
        set of uids. Each uid is stored as a string."""
-    uid2user = {"0": "root"}
-    user2uid = {"root": "0"}
-    if os.path.isfile(flnm):
-        with open(flnm, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        pattern = r"Added user \w+ \(\d+ -"
-        for line in lines:
-            match = re.findall(pattern, line)
-            if match:
-                uid = match[0].split("(")[1].split()[0]
-                netid = match[0].split("(")[0].strip().split()[-1]
-                assert uid.isnumeric(), f"{uid} is not numeric: {line}"
-                uid2user[uid] = netid
-                user2uid[netid] = uid
-    else:
+    if not os.path.isfile(flnm):
         print(f"{flnm} was not found.")
-    for uid in uids:
-        if uid not in uid2user:
-            found = False
-            ldap = "ldap://ldap01.rc.princeton.edu"
-            cmd = f"ldapsearch -x -H {ldap} -b dc=rc,dc=princeton,dc=edu uidNumber={uid} uid"
-            output = subprocess.run(cmd,
-                                    stdout=subprocess.PIPE,
-                                    shell=True,
-                                    timeout=5,
-                                    text=True,
-                                    check=True)
-            lines = output.stdout.split('\n')
-            for line in lines:
-                if line.startswith("uid: "):
-                    netid = line.split()[1]
-                    uid2user[uid] = netid
-                    user2uid[netid] = uid
-                    found = True
-                    break
-            if not found:
-                print(f"A netid for uid {uid} was not found.")
+    index = identity.get_index(log=flnm)
+    uid2user = dict(index.log_uid2user)
+    user2uid = dict(index.log_user2uid)
+    def search(uid):
+        cmd = f"ldapsearch -x -H {RC_LDAP} -b {RC_BASE} uidNumber={uid} uid"
+        output = subprocess.run(cmd,
+                                stdout=subprocess.PIPE,
+                                shell=True,
+                                timeout=5,
+                                text=True,
+                                check=True)
+        for line in output.stdout.split('\n'):
+            if line.startswith("uid: "):
+                return line.split()[1]
+        return None
+    missing = sorted(uid for uid in uids if uid not in uid2user)
+    netids, _ = run_ldap_lookups(search, missing, workers=workers)
+    for uid in missing:
+        netid = netids.get(uid)
+        if netid:
+            uid2user[uid] = netid
+            user2uid[netid] = uid
+        else:
+            print(f"A netid for uid {uid} was not found.")
     return uid2user, user2uid
 
 
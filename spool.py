@@ -0,0 +1,124 @@
+import os
+import json
+import threading
+from datetime import datetime
+
+MANIFEST = "manifest.json"
+JOURNAL = "journal.jsonl"
+
+
+def run_dir(spooldir, report_type, start_date, end_date):
+    """Return the spool directory of the reports of one reporting period."""
+    return os.path.join(spooldir, f"{report_type}_{start_date.isoformat()}_{end_date.isoformat()}")
+
+
+class Spool:
+
+    """Directory of the rendered reports of one run with one JSON file per
+       recipient (the report and its addressees) and a journal of the emails
+       that were sent. Each report is written atomically and the manifest is
+       written last so a spool with a manifest is complete. Every delivery is
+       appended to the journal (and flushed to disk) so that a run that died
+       while sending resumes with the first email that was not sent. A crash
+       between sending an email and journaling it repeats that one email."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def files(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(f for f in os.listdir(self.path) if f.endswith(".json") and f != MANIFEST)
+
+    def clear(self):
+        """Remove the reports, manifest and journal of a previous run."""
+        for fname in self.files() + [MANIFEST, JOURNAL]:
+            if os.path.isfile(os.path.join(self.path, fname)):
+                os.remove(os.path.join(self.path, fname))
+
+    def write(self, index, recipient, report, addressees):
+        """Write the report of the recipient (index gives the sending order)."""
+        os.makedirs(self.path, exist_ok=True)
+        fname = os.path.join(self.path, f"{index:05d}_{recipient}.json")
+        with open(f"{fname}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"recipient":recipient, "addressees":list(addressees), "report":report}, f)
+        os.replace(f"{fname}.tmp", fname)
+
+    def finish(self, **meta):
+        """Write the manifest (meta plus the number of reports)."""
+        manifest = dict(meta, count=len(self.files()), created=datetime.now().isoformat(timespec="seconds"))
+        fname = os.path.join(self.path, MANIFEST)
+        with open(f"{fname}.tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(f"{fname}.tmp", fname)
+
+    def manifest(self):
+        """Return the manifest or None if the spool is incomplete."""
+        fname = os.path.join(self.path, MANIFEST)
+        if not os.path.isfile(fname):
+            return None
+        with open(fname, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def read(self, fname):
+        with open(os.path.join(self.path, fname), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def delivered(self):
+        """Return the set of (file, addressee) in the journal. A line that was
+           cut short by a crash is ignored."""
+        fname = os.path.join(self.path, JOURNAL)
+        if not os.path.isfile(fname):
+            return set()
+        done = set()
+        with open(fname, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                done.add((entry["file"], entry["addressee"]))
+        return done
+
+    def pending(self):
+        """Return the (file, addressee) that were not sent in the sending order."""
+        done = self.delivered()
+        return [(fname, addressee) for fname in self.files() for addressee in self.read(fname)["addressees"]
+                if (fname, addressee) not in done]
+
+    def drain(self, send, senders=1):
+        """Call send(report, addressee) from senders threads for each email that
+           was not sent (taken in order) and journal it. The first error stops
+           the sending and is raised. Returns the number of emails sent."""
+        pending = iter(self.pending())
+        lock = threading.Lock()
+        errors = []
+        sent = [0]
+        with open(os.path.join(self.path, JOURNAL), "a", encoding="utf-8") as journal:
+            def sender():
+                while True:
+                    with lock:
+                        item = None if errors else next(pending, None)
+                    if item is None:
+                        return
+                    fname, addressee = item
+                    try:
+                        send(self.read(fname)["report"], addressee)
+                    except Exception as error:
+                        with lock:
+                            errors.append(error)
+                        return
+                    entry = {"file":fname, "addressee":addressee, "sent":datetime.now().isoformat(timespec="seconds")}
+                    with lock:
+                        journal.write(json.dumps(entry) + "\n")
+                        journal.flush()
+                        os.fsync(journal.fileno())
+                        sent[0] += 1
+            threads = [threading.Thread(target=sender, daemon=True) for _ in range(max(1, senders))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        return sent[0]
@@ -1,11 +1,33 @@
 import sys
 sys.path.append("../")
+import os
+import io
+import time
+import threading
+import subprocess
+import contextlib
 import unittest
+import tempfile
 import pandas as pd
 from datetime import date
+from datetime import datetime
 from sponsor import get_full_name_from_ldap
 from sponsor import get_sponsor_netid_per_cluster_dict_from_ldap
+from sponsor import sponsor_dicts_from_ldif
+from sponsor import run_ldap_lookups
+from sponsor import get_full_name_of_user_from_log
+from sponsor import get_sponsor_netid_of_user_from_log
 import monthly_sponsor_reports as msr
+import jobcache
+import effcache
+import ldapcache
+import identity
+import render
+import spool
+import smtplib
+import mailer
+import DataStorage
+import snapshots
 
 
 class TestDateRange(unittest.TestCase):
@@ -33,6 +55,9 @@ class TestDelineatePartitions(unittest.TestCase):
         assert "gpu" == msr.delineate_partitions("della", 1, "gpu")
         assert "cpu" == msr.delineate_partitions("tiger", 0, "cpu")
         assert "all" == msr.delineate_partitions("stellar", 0, "all")
+        assert "cryoem(gpu)" == msr.delineate_partitions("tiger", 1, "cryoem")
+        assert "gpu-ee(cpu)" == msr.delineate_partitions("della", 0, "gpu-ee")
+        assert "gpu-ee" == msr.delineate_partitions("tiger", 1, "gpu-ee")
 
 
 class TestSponsorName(unittest.TestCase):
@@ -57,6 +82,289 @@ class TestSponsor(unittest.TestCase):
         assert get_sponsor_netid_per_cluster_dict_from_ldap(netid="bigfoot", verbose=False) == d
 
 
+    def test_sponsor_dicts_from_ldif(self):
+        # recorded output of ldapsearch -f - with two OR filters
+        ldif = """# extended LDIF
+#
+# LDAPv3
+# base <dc=rc,dc=princeton,dc=edu> with scope subtree
+# filter pattern: %s
+# requesting: displayname manager description
+#
+
+#
+# filter: (|(uid=jdh4)(uid=aturing))
+#
+
+# jdh4, People, rc.princeton.edu
+dn: uid=jdh4,ou=People,dc=rc,dc=princeton,dc=edu
+displayname: Jonathan D. Halverson
+manager: uid=curt,ou=People,dc=rc,dc=princeton,dc=edu
+description: della:curt=2022-01-01,stellar:curt=2022-01-01,tiger:USER=2022-01
+ -01,traverse:wtang (retired)=2022-01-01
+
+# search result
+search: 2
+result: 0 Success
+
+#
+# filter: (|(uid=jnunez))
+#
+
+# jnunez, People, rc.princeton.edu
+dn: uid=jnunez,ou=People,dc=rc,dc=princeton,dc=edu
+displayname:: Sm9zw6kgTsO6w7Fleg==
+manager: uid=wtang,ou=People,dc=rc,dc=princeton,dc=edu
+manager: uid=curt,ou=People,dc=rc,dc=princeton,dc=edu
+
+# search result
+search: 3
+result: 0 Success
+
+# numResponses: 2
+# numEntries: 1
+"""
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            result = sponsor_dicts_from_ldif(["jdh4", "aturing", "jnunez"], ldif, strip=True)
+        assert result["jdh4"] == {"della":"curt", "stellar":"curt", "tiger":"jdh4", "tigressdata":"curt", "traverse":"wtang", "displayname":"Jonathan D. Halverson"}
+        assert result["aturing"] == {"della":None, "stellar":None, "tiger":None, "tigressdata":None, "traverse":None, "displayname":None}
+        assert result["jnunez"] == {"della":"wtang", "stellar":"wtang", "tiger":"wtang", "tigressdata":"wtang", "traverse":"wtang", "displayname":"Jose Nunez"}
+        assert "W: User jnunez has multiple primary sponsors: wtang,curt. Using wtang." in out.getvalue()
+        assert "W: Sponsor entry of USER found for jdh4 on tiger. Corrected to jdh4." in out.getvalue()
+
+
+    def test_run_ldap_lookups(self):
+        calls, active, peak = {}, [0], [0]
+        lock = threading.Lock()
+        def lookup(netid):
+            with lock:
+                calls[netid] = calls.get(netid, 0) + 1
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.01)
+            with lock: active[0] -= 1
+            if netid == "bigfoot" or (netid == "jdh4" and calls[netid] == 1):
+                raise subprocess.TimeoutExpired("ldapsearch", 5)
+            return netid.upper()
+        netids = ["jdh4", "bigfoot"] + [f"u{i}" for i in range(10)]
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            results, failures = run_ldap_lookups(lookup, netids, workers=3, retries=2, backoff=0)
+        assert results["jdh4"] == "JDH4" and len(results) == 11
+        assert list(failures) == ["bigfoot"] and calls["bigfoot"] == 3
+        assert peak[0] <= 3
+        assert out.getvalue().startswith("W: 1 of 12 LDAP lookups failed after 2 retries:")
+
+
+class TestLdapCache(unittest.TestCase):
+
+    def test_ldap_cache(self):
+        d = {"della":"curt", "stellar":"curt", "tiger":"curt", "tigressdata":"curt", "traverse":"curt", "displayname":"Jonathan D. Halverson"}
+        unknown = {"della":None, "stellar":None, "tiger":None, "tigressdata":None, "traverse":None, "displayname":None}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = f"{tmpdir}/ldap.sqlite"
+            cache = ldapcache.LdapCache(fname, negative_ttl_days=1)
+            cache.put("sponsor", {"jdh4":d, "bigfoot":unknown}, ldapcache.sponsor_found)
+            cache.conn.execute("UPDATE lookups SET stored = stored - 2 * 86400")
+            # the negative entry has expired
+            assert cache.get("sponsor", {"jdh4", "bigfoot"}) == {"jdh4":d}
+            cache.close()
+            cache = ldapcache.LdapCache(fname, offline=True)
+            with contextlib.redirect_stdout(io.StringIO()):
+                assert ldapcache.get_sponsor_dicts(cache, ["jdh4", "bigfoot", "jdh4"]) == {"jdh4":d, "bigfoot":unknown}
+                assert ldapcache.get_full_name(cache, "aturing") is None
+            assert ldapcache.get_full_name(cache, "jnunez", {"jnunez":"José Núñez"}) == "Jose Nunez"
+            cache.close()
+            assert ldapcache.LdapCache(fname, refresh=True).get("sponsor", {"jdh4"}) == {}
+            # more netids than fit in one SELECT
+            cache = ldapcache.LdapCache(fname)
+            names = {f"u{i}": f"User {i}" for i in range(2 * ldapcache.CHUNK_SIZE + 1)}
+            cache.put("name", names, lambda name: name is not None)
+            assert cache.get("name", list(names) + ["bigfoot"]) == names
+            cache.close()
+
+
+class TestSpool(unittest.TestCase):
+
+    def test_spool_resume(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = spool.run_dir(tmpdir, "users", date(2024, 4, 15), date(2024, 5, 14))
+            outbox = spool.Spool(path)
+            outbox.write(0, "jdh4", "report 1", ["jdh4@princeton.edu", "halverson@princeton.edu"])
+            outbox.write(1, "bill", "report 2", ["bill@princeton.edu"])
+            assert outbox.manifest() is None
+            outbox.finish(report_type="users")
+            assert outbox.manifest()["count"] == 2
+            sent, down = [], [True]
+            def send(report, addressee):
+                if addressee == "bill@princeton.edu" and down[0]: raise ConnectionError
+                sent.append((report, addressee))
+            with self.assertRaises(ConnectionError):
+                outbox.drain(send)
+            assert len(sent) == 2
+            # a new spool object (the next run) only sends what is left
+            outbox = spool.Spool(path)
+            assert outbox.pending() == [("00001_bill.json", "bill@princeton.edu")]
+            down[0] = False
+            assert outbox.drain(send) == 1
+            assert sent[-1] == ("report 2", "bill@princeton.edu")
+            assert outbox.pending() == [] and outbox.drain(send) == 0
+
+    def test_spool_drain_senders(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outbox = spool.Spool(tmpdir)
+            for i in range(20):
+                outbox.write(i, f"u{i}", f"report {i}", [f"u{i}@princeton.edu"])
+            outbox.finish(report_type="users")
+            lock, active, peak = threading.Lock(), [0], [0]
+            def send(report, addressee):
+                with lock:
+                    active[0] += 1
+                    peak[0] = max(peak[0], active[0])
+                time.sleep(0.01)
+                with lock: active[0] -= 1
+            assert outbox.drain(send, senders=4) == 20
+            assert 1 < peak[0] <= 4
+            assert outbox.pending() == [] and len(outbox.delivered()) == 20
+
+
+class TestMailer(unittest.TestCase):
+
+    def test_mailer(self):
+        # stand-in for smtplib.SMTP that drops the connection after every third email
+        connections, delivered = [], []
+        class FakeSMTP:
+            def __init__(self, host, port):
+                self.count = 0
+                connections.append(self)
+            def sendmail(self, sender, addressee, message):
+                if addressee == "bigfoot@princeton.edu":
+                    raise smtplib.SMTPRecipientsRefused({addressee:(550, b"unknown")})
+                if self.count == 3:
+                    raise smtplib.SMTPServerDisconnected("dropped")
+                self.count += 1
+                delivered.append(addressee)
+            def quit(self):
+                raise smtplib.SMTPServerDisconnected("dropped")
+            def close(self):
+                pass
+        smtp = mailer.Mailer(rate=1000, backoff=0, factory=FakeSMTP)
+        start = time.monotonic()
+        for i in range(10):
+            msr.send_email("report", f"u{i}@princeton.edu", date(2024, 1, 1), date(2024, 3, 31), smtp=smtp)
+        assert time.monotonic() - start >= 0.009
+        assert delivered == [f"u{i}@princeton.edu" for i in range(10)]
+        assert len(connections) == 4 and smtp.reconnects == 3 and smtp.sent == 10
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            smtp.send("cses@princeton.edu", "bigfoot@princeton.edu", "report")
+        assert len(connections) == 4
+        smtp.close()
+
+
+class TestDataStorage(unittest.TestCase):
+
+    def test_fetch(self):
+        def series(name, value, **labels):
+            return {"metric":dict(labels, __name__=name), "value":[1727323287.354, str(value)]}
+        response = {"status":"success", "data":{"resultType":"vector", "result":[
+            series("gpfs_quota_block_usage_bytes", 5, fs="projects2.storage", filesetname="WEBB", uid="150340", quota_type="USR"),
+            series("gpfs_quota_block_limit_hard_bytes", 9, fs="projects2.storage", filesetname="WEBB", uid="150340", quota_type="USR"),
+            series("gpfs_quota_block_usage_bytes", 7, fs="della.gpfs", filesetname="root", uid="150340", quota_type="USR"),
+            series("gpfs_quota_files_usage", 3, fs="projects2.storage", filesetname="WEBB", quota_type="GRP", gid="0"),
+            series("gpfs_quota_files_usage", 2, fs="projects2.storage", filesetname="PNI", quota_type="FILESET")]}}
+        # stand-in for a requests session
+        calls = []
+        class Session:
+            def get(self, url, params, timeout):
+                calls.append(params["query"])
+                return type("Response", (), {"json":lambda self: response})()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            quotas = DataStorage.DataStorage.fetch(session=Session(), record=f"{tmpdir}/quotas.json")
+            assert len(calls) == 1 and "gpfs_quota_files_limit_hard" in calls[0]
+            replayed = DataStorage.DataStorage.fetch(response=f"{tmpdir}/quotas.json")
+        for quota in (quotas, replayed):
+            assert quota["gpfs_quota_block_usage_bytes"].d == {"150340":{"projects2.storage.WEBB":5, "della.gpfs.root":7}}
+            assert quota["gpfs_quota_block_limit_hard_bytes"].d == {"150340":{"projects2.storage.WEBB":9}}
+            assert quota["gpfs_quota_files_usage"].d == {"WEBB":{"projects2.storage.WEBB.0":3}, "PNI":{"projects2.storage.PNI":2}}
+            assert quota["gpfs_quota_files_limit_hard"].d == {}
+        table = quotas["gpfs_quota_files_usage"].table
+        assert table.shape == (4, 8) and table["gpfs_quota_block_usage_bytes"].isna().sum() == 2
+        single = {"data":{"result":response["data"]["result"][:1]}}
+        assert DataStorage.DataStorage("gpfs_quota_block_usage_bytes", response=single).d == {"150340":{"projects2.storage.WEBB":5}}
+
+    def test_fileset_index(self):
+        usage = DataStorage.DataStorage.__new__(DataStorage.DataStorage)
+        usage.d = {"150340":{"projects2.storage.WEBB":5, "della.gpfs.root":7},
+                   "999999":{"projects2.storage.WEBB":0},
+                   "WEBB":{"projects2.storage.WEBB":1}}
+        index = usage.fileset_index({"150340":"jdh4"}.get)
+        assert index["projects2.storage.WEBB"] == [["jdh4", "150340", 5], ["UNKNOWN", "999999", 0], ["UNKNOWN", "WEBB", 1]]
+        ids = type("Ids", (), {"uid":lambda self, netid: None})()
+        sp = pd.DataFrame({"cluster":["della"], "netid":["jdh4"]})
+        _, projects = msr.sponsor_storage("mawebb", sp, usage.d, ids, {"mawebb":["WEBB", "GONE"]}, index)
+        assert projects == [("WEBB", [["jdh4", "150340", 5]])]
+
+    def test_snapshots(self):
+        def series(value, first, last, **labels):
+            # recorded query_range series with one sample per day
+            t0 = datetime(2024, 9, first, 9).timestamp()
+            values = [[t0 + 86400 * i, str(value(i))] for i in range(last - first + 1)]
+            return {"metric":dict(labels, __name__="gpfs_quota_block_usage_bytes", fs="projects2.storage", quota_type="USR"), "values":values}
+        calls = []
+        def query(params):
+            calls.append(params)
+            return {"data":{"resultType":"matrix", "result":[
+                series(lambda i: 100 + 10 * i, 1, 10, filesetname="WEBB", uid="150340"),
+                series(lambda i: 50, 4, 10, filesetname="WEBB", uid="230858"),
+                series(lambda i: 7, 1, 10, filesetname="PNI", uid="150340")]}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = f"{tmpdir}/storage"
+            fields = ["gpfs_quota_block_usage_bytes"]
+            snapshots.write_snapshot(store, date(2024, 9, 5), DataStorage.quota_table({"data":{"result":[]}}, fields))
+            written = snapshots.backfill(store, date(2024, 9, 1), date(2024, 9, 10), fields=fields, chunk_days=4, query=query)
+            assert len(calls) == 3 and date(2024, 9, 5) not in written and len(written) == 9
+            open(f"{store}/2024-09-05 (copy).{jobcache.FORMAT}", "w").close()
+            assert snapshots.snapshot_dates(store) == [date(2024, 9, d) for d in range(1, 11)]
+            hist = snapshots.history(store, date(2024, 9, 1), date(2024, 9, 4), key="projects2.storage.WEBB", group=["key"])
+            assert hist["gpfs_quota_block_usage_bytes"].tolist() == [100, 110, 120, 180]
+            delta = snapshots.deltas(store, date(2024, 9, 1), date(2024, 9, 10), key="projects2.storage.WEBB")
+            assert delta[["owner", "first", "last", "change"]].values.tolist() == [["150340", 100, 190, 90], ["230858", 0, 50, 50]]
+
+
+class TestIdentityIndex(unittest.TestCase):
+
+    def test_identity_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log, uids, departed = f"{tmpdir}/changes.log", f"{tmpdir}/master.uids", f"{tmpdir}/departed.csv"
+            with open(log, "w") as f:
+                f.write("2023-05-01 10:00:01 - Added user jdh4 (150001 - Jonathan Halverson) with sponsor curt\n")
+                f.write("2023-06-01 10:00:01 - Added user aturing (150002 - Alan Turing) with sponsor wtang\n")
+            with open(uids, "w") as f:
+                f.write("0,root\n150001,jdh4\n150003,gbwright\n")
+            with open(departed, "w") as f:
+                f.write("Netid_,Sponsor_Netid_,Name_\nbigfoot,curt,Big Foot\n")
+            index = identity.IdentityIndex(f"{tmpdir}/identity.json", log=log, uids=uids, departed=departed).refresh()
+            assert index.netid("150002") == "aturing" and index.netid("150003") == "gbwright"
+            assert index.uid("jdh4") == "150001" and index.uid("root") == "0"
+            assert index.name("aturing") == "Alan Turing" and index.sponsor("aturing") == "wtang"
+            assert index.departed_user("bigfoot") == ["curt", "Big Foot"]
+            index.save()
+            offset = index.offset
+            # only the appended lines are parsed (a partial line waits for the next refresh)
+            with open(log, "a") as f:
+                f.write("2024-01-01 09:00:00 - Removed user aturing (Alan M. Turing) sponsor curt; left\n2024-01-02")
+            index = identity.IdentityIndex(f"{tmpdir}/identity.json", log=log, uids=uids, departed=departed)
+            assert index.offset == offset
+            index.refresh()
+            assert index.name("aturing") == "Alan M. Turing" and index.sponsor("aturing") == "curt"
+            assert index.offset == os.path.getsize(log) - len("2024-01-02")
+            assert get_full_name_of_user_from_log("aturing", flnm=log) == "Alan M. Turing"
+            assert get_sponsor_netid_of_user_from_log("jdh4", flnm=log) == "curt"
+            # lines cut short after the keyword are skipped
+            for line in ["2024-02-01 - Added user ", "2024-02-01 - Removed user ", "2024-02-01 - Added user ab12 with sponsor "]:
+                index.add_log_line(line)
+            assert index.name("aturing") == "Alan M. Turing" and index.sponsor("ab12") is None
+
+
 class TestMonthlySponsorReports(unittest.TestCase):
 
     def test_gpus_per_job(self):
@@ -77,6 +385,39 @@ class TestMonthlySponsorReports(unittest.TestCase):
         expected = pd.Series([100, 0, 0]).rename("cpu-only-seconds")
         pd.testing.assert_series_equal(result["cpu-only-seconds"], expected)
 
+    def test_start_date_labels(self):
+        start = pd.Series([1700000000, 1700000000 + 899, 1711846799, 1711846800, 1730613600, 123456789])
+        expected = [datetime.fromtimestamp(x).strftime("%a %-m/%-d") for x in start]
+        assert msr.start_date_labels(start).tolist() == expected
+        assert msr.start_date_labels(start).ordered
+
+    def test_compact_job_table(self):
+        jobs = [["della", "cpu", 100, 100, "billing=8,cpu=1,mem=16G,node=1", 123456789, "JS1:None"],
+                ["della", "gpu", 200, 100, "billing=8,cpu=2,gres/gpu=1,mem=16G,node=1", 123456789, "JS1:None"]]
+        df = pd.DataFrame(jobs, columns=["cluster", "partition", "cpu-seconds", "elapsedraw", "alloctres", "start", "admincomment"])
+        df, admincomment = msr.compact_job_table(df)
+        assert "admincomment" not in df.columns
+        assert admincomment.tolist() == ["JS1:None", "JS1:None"]
+        assert df.partition.dtype == "category" and df.partition.cat.ordered
+        assert df["cpu-seconds"].dtype == "int16"
+        assert df["start"].dtype == "int32"
+        assert df.partition.min() == "cpu"
+
+    def test_decode_usage(self):
+        stats = {"nodes":{"n1":{"cpus":2, "total_time":150, "gpu_utilization":{"0":50}}}}
+        jobs = pd.DataFrame({"jobid":["1", "2", "3", "4"], "cluster":["della"] * 4, "elapsedraw":[100] * 4}, index=[3, 5, 8, 9])
+        admincomment = pd.Series(["JS1:None", stats, "JS1:None", stats], index=jobs.index)
+        is_gpu = pd.Series([False, False, False, True], index=jobs.index)
+        for workers in (1, 2):
+            result = msr.decode_usage(jobs, admincomment, is_gpu, workers=workers, batchsize=1)
+            assert result.index.tolist() == [5, 9]
+            assert list(result.columns) == msr.effcache.COLUMNS
+            cpu = msr.cpu_efficiency(stats, 100, "2", "della")
+            gpu = msr.gpu_efficiency(stats, 100, "4", "della")
+            assert result.loc[5].tolist()[:2] == [cpu[0], cpu[1]]
+            assert result.loc[5].isna().tolist()[2:] == [True, True]
+            assert result.loc[9].tolist() == [cpu[0], cpu[1], gpu[0], gpu[1]]
+
     def test_double_groupby(self):
         # construct simulated sacct output
         jobs = [[100, "jdh4",     "tiger", "cses", "cpu", 50000, 50000, 100000, 1, 1, "billing=8,cpu=1,mem=16G,node=1",            123456789, 234567890, 234567890, "JS1:None"],
@@ -88,6 +429,7 @@ class TestMonthlySponsorReports(unittest.TestCase):
         fields = "jobid,netid,cluster,account,partition,cpu-seconds,elapsedraw,limit-minutes,nodes,cores,alloctres,submit,eligible,start,admincomment"
         df.columns = fields.split(",")
         df = msr.add_new_and_derived_fields(df)
+        assert df["cluster-partition"].dtype == "category" and df["start-date"].dtype == "category"
         d1 = {"della":"curt", "stellar":"curt", "tiger":"wtang", "traverse":"curt", "displayname":"Garrett Wright"}
         d2 = {"della":"curt", "stellar":"curt", "tiger":"curt",  "traverse":"curt", "displayname":"Jonathan D. Halverson"}
         d3 = {"della":"curt", "stellar":"curt", "tiger":"curt",  "traverse":"curt", "displayname":"William Wichser"}
@@ -126,3 +468,241 @@ class TestMonthlySponsorReports(unittest.TestCase):
         pd.testing.assert_series_equal(result["CPU-rank"], expected)
         expected = pd.Series(["1/5", "4/5", "3/5", "5/5", "2/5"]).rename("GPU-rank")
         pd.testing.assert_series_equal(result["GPU-rank"], expected)
+
+        # ties are broken by netid and the GPU rank is N/A on CPU partitions
+        jobs = [["della__cpu", "bill", 100, 0],
+                ["della__cpu", "alan", 100, 0],
+                ["della__cpu", "carl", 300, 0],
+                ["della__cpu", "dave",   0, 0]]
+        df = pd.DataFrame(jobs, columns=fields.split(","))
+        result = msr.add_cpu_and_gpu_rankings(df, df.copy())
+        assert result["CPU-rank"].tolist() == ["3/4", "2/4", "1/4", "4/4"]
+        assert result["GPU-rank"].tolist() == ["N/A"] * 4
+
+    def test_sponsor_summary(self):
+        ov = pd.DataFrame([["della", "curt",  900,  0],
+                           ["della", "curt",  100, 10],
+                           ["della", "wtang", 800, 30],
+                           ["della", None,    200,  0],
+                           ["tiger", "wtang",   0,  0]], columns=["cluster", "sponsor", "cpu-hours", "gpu-hours"])
+        sm = msr.sponsor_summary(ov)
+        assert sm.loc[("della", "curt")].tolist() == [1000, 10, 3, 2000, 50, 1, 40, 25, 2]
+        assert sm.loc[("della", "wtang")].tolist() == [800, 30, 3, 2000, 40, 2, 40, 75, 1]
+        assert sm.loc[("tiger", "wtang")].tolist() == [0, 0, 1, 0, 0, 1, 0, 0, 1]
+        # every sponsor at or above 1%: the values must print as in the emailed paragraph
+        ov = pd.DataFrame([["della", "curt", 950, 0], ["della", "wtang", 50, 0]], columns=["cluster", "sponsor", "cpu-hours", "gpu-hours"])
+        rows = msr.sponsor_summary(ov).xs("curt", level="sponsor").to_dict("index")
+        sm = rows["della"]
+        text = f"{sm['cpu-hours']} CPU-hours or {sm['cpu-hours-pct']}% of the {sm['cpu-hours-total']} ranked {sm['cpu-hours-rank']} of {sm['total-sponsors']}"
+        assert text == "950 CPU-hours or 95% of the 1000 ranked 1 of 2"
+        sm = msr.sponsor_summary(ov).xs("wtang", level="sponsor").to_dict("index")["della"]
+        assert f"{sm['cpu-hours-pct']}% {sm['cpu-hours-rank']} {sm['gpu-hours-pct']}%" == "5.0% 2 0%"
+
+    def test_report_plan(self):
+        dg = pd.DataFrame([["tiger__gpu", "jdh4", "curt"],
+                           ["della__cpu", "bill", "curt"],
+                           ["della__gpu", "jdh4", "wtang"],
+                           ["della__cpu", "jdh4", "curt"]], columns=["cluster-partition", "netid", "sponsor"])
+        plan = msr.report_plan(dg, "netid", sort_by="cluster-partition")
+        assert sorted(plan) == ["bill", "jdh4"]
+        assert plan["jdh4"]["cluster-partition"].tolist() == ["della__cpu", "della__gpu", "tiger__gpu"]
+        plan = msr.report_plan(dg, "sponsor")
+        assert plan["curt"].index.tolist() == [0, 1, 3]
+
+    def test_render_table(self):
+        df = pd.DataFrame({"NetID":["jdh4", "aturing"],
+                           "CPU-hours":[12345, 7],
+                           "GPU-eff":["N/A", None],
+                           "    Amount    ":["5 GB  (5%)", "95 GB (95%)"]})
+        expected = df.to_string(index=False, justify="center")
+        columns = [df[col].tolist() for col in df.columns]
+        assert render.render_table(list(df.columns), columns) == expected
+        assert render.proportions([1, 3]) == (["1 (25%)", "3 (75%)"], False)
+        assert render.proportions([0, 0]) == ([0, 0], True)
+
+    def test_render_reports(self):
+        tasks = [("traverse", 0, "all"), ("della", 1, "gpu"), ("tiger", 1, "cryoem"), ("della", 0, "gpu-ee")]
+        expected = ["all(cpu)", "gpu", "cryoem(gpu)", "gpu-ee(cpu)"]
+        assert list(msr.render_reports(msr.delineate_partitions, tasks, workers=1)) == expected
+        assert list(msr.render_reports(msr.delineate_partitions, tasks, workers=3, window=2)) == expected
+
+    def test_pipeline_reports(self):
+        consumed, sent, lock = [], [], threading.Lock()
+        def reports():
+            for i in range(20):
+                # the renderer never gets more than the queue size (2) plus the report held by
+                # each sender (2) plus the report being consumed ahead of the senders
+                with lock: assert i - len(sent) <= 5
+                yield f"report {i}"
+        def consume(i, report):
+            consumed.append(i)
+            return [f"u{i}@princeton.edu"]
+        def send(report, addressee):
+            time.sleep(0.002)
+            with lock: sent.append(addressee)
+        msr.pipeline_reports(reports(), consume, send, senders=2, maxsize=2)
+        assert consumed == list(range(20))
+        assert sorted(sent) == sorted(f"u{i}@princeton.edu" for i in range(20))
+        def fail(report, addressee):
+            if addressee == "u3@princeton.edu": raise smtplib.SMTPDataError(554, b"rejected")
+        consumed.clear()
+        with self.assertRaises(smtplib.SMTPDataError):
+            msr.pipeline_reports(reports(), consume, fail, senders=1, maxsize=1)
+        assert len(consumed) < 20
+
+    def test_parse_sacct_stream(self):
+        stream = io.StringIO("100|jdh4|della|cses|cpu|7200|3600|billing=8,cpu=2,mem=16G,node=1|1700000000|JS1:None\n"
+                             "101_2|bill|tiger2|cses|gpu|100|100||Unknown|\n")
+        fields = "jobid,user,cluster,account,partition,cputimeraw,elapsedraw,alloctres,start,admincomment"
+        renamings = {"user":"netid", "cputimeraw":"cpu-seconds"}
+        df = msr.parse_sacct_stream(stream, fields, renamings, ["cpu-seconds", "elapsedraw"], chunksize=1)
+        assert list(df.columns) == ["jobid", "netid", "cluster", "account", "partition", "cpu-seconds", "elapsedraw", "alloctres", "start", "admincomment"]
+        assert df["cpu-seconds"].tolist() == [7200, 100]
+        assert df["cpu-seconds"].dtype == "int64"
+        assert df.jobid.tolist() == ["100", "101_2"]
+        assert df.alloctres.tolist() == ["billing=8,cpu=2,mem=16G,node=1", ""]
+        assert df.start.tolist() == ["1700000000", "Unknown"]
+
+    def test_parse_sacct_stream_empty_numeric(self):
+        lines = "100|jdh4|7200|3600\n101|bill||100\n102|ab12|50|\n"
+        fields = "jobid,user,cputimeraw,elapsedraw"
+        for chunksize in (1, 2, 1000):
+            df = msr.parse_sacct_stream(io.StringIO(lines), fields, {"cputimeraw":"cpu-seconds"},
+                                        ["cpu-seconds", "elapsedraw"], chunksize=chunksize)
+            assert pd.api.types.is_numeric_dtype(df["cpu-seconds"])
+            assert pd.api.types.is_numeric_dtype(df["elapsedraw"])
+            assert df["cpu-seconds"].fillna(-1).tolist() == [7200, -1, 50]
+            assert df["elapsedraw"].fillna(-1).tolist() == [3600, 100, -1]
+            assert df.jobid.tolist() == ["100", "101", "102"]
+
+    def test_sacct_shards(self):
+        flags = "-L -a -X -P -n"
+        shards = msr.sacct_shards(flags, date(2022, 2, 1), date(2022, 4, 30), ["della", "tiger2"], period="month")
+        assert len(shards) == 6
+        assert shards[0] == ("-a -X -P -n -M della", date(2022, 2, 1), date(2022, 2, 28))
+        assert shards[-1] == ("-a -X -P -n -M tiger2", date(2022, 4, 1), date(2022, 4, 30))
+        shards = msr.sacct_shards(flags, date(2022, 4, 15), date(2022, 5, 14), [], period="week")
+        assert [shard[0] for shard in shards] == 5 * [flags]
+        assert shards[-1][1:] == (date(2022, 5, 13), date(2022, 5, 14))
+
+    def test_merge_job_shards(self):
+        cols = ["jobid", "cluster", "cpu-seconds"]
+        shard1 = pd.DataFrame([["1", "della", 10], ["2", "della", 20]], columns=cols)
+        shard2 = pd.DataFrame([["2", "della", 25], ["2", "tiger", 30]], columns=cols)
+        expected = pd.DataFrame([["1", "della", 10], ["2", "della", 25], ["2", "tiger", 30]], columns=cols)
+        pd.testing.assert_frame_equal(msr.merge_job_shards([shard1, shard2]), expected)
+
+
+class TestJobCache(unittest.TestCase):
+
+    def test_cache_roundtrip(self):
+        df = pd.DataFrame([["1", "della", 10], ["2", "tiger", 20]], columns=["jobid", "cluster", "cpu-seconds"])
+        params = jobcache.cache_params(date(2022, 2, 1), date(2022, 4, 30), ["tiger", "della"], "-L -a -X -P -n", "jobid,cluster,cputimeraw")
+        with tempfile.TemporaryDirectory() as cachedir:
+            assert jobcache.read_cache(cachedir, params) is None
+            jobcache.write_cache(cachedir, params, df)
+            pd.testing.assert_frame_equal(jobcache.read_cache(cachedir, params), df)
+            pd.testing.assert_frame_equal(jobcache.read_cache(cachedir, params, columns=["cpu-seconds"]), df[["cpu-seconds"]])
+            assert jobcache.read_cache(cachedir, params, columns=["nodes"], verbose=False) is None
+            # different fields or flags must not match
+            other = jobcache.cache_params(date(2022, 2, 1), date(2022, 4, 30), ["tiger", "della"], "-L -a -X -P -n", "jobid,cluster")
+            assert jobcache.read_cache(cachedir, other) is None
+            # an entry written before the end of the period is stale
+            params = jobcache.cache_params(date.today(), date.today(), ["della"], "-L -a -X -P -n", "jobid,cluster,cputimeraw")
+            jobcache.write_cache(cachedir, params, df)
+            assert jobcache.read_cache(cachedir, params, verbose=False) is None
+
+    def test_cache_pruning(self):
+        df = pd.DataFrame([["1", "della", 10]], columns=["jobid", "cluster", "cpu-seconds"])
+        cache_params = lambda start, end, fields: jobcache.cache_params(start, end, ["della"], "-L -a -X -P -n", fields)
+        first = cache_params(date(2022, 2, 1), date(2022, 4, 30), "jobid,cluster,cputimeraw")
+        later = cache_params(date(2022, 3, 1), date(2022, 5, 31), "jobid,cluster,cputimeraw")
+        with tempfile.TemporaryDirectory() as cachedir:
+            jobcache.write_cache(cachedir, first, df)
+            jobcache.write_cache(cachedir, later, df)
+            open(os.path.join(cachedir, "sacct_orphan.feather.tmp"), "w").close()
+            # the same period with other fields supersedes the first entry
+            fname = jobcache.write_cache(cachedir, cache_params(date(2022, 2, 1), date(2022, 4, 30), "jobid,cluster"), df)
+            assert jobcache.read_cache(cachedir, first) is None
+            assert jobcache.read_cache(cachedir, later) is not None
+            manifest = jobcache.load_manifest(cachedir)
+            assert len(manifest) == 2
+            assert sorted(f for f in os.listdir(cachedir) if f.startswith("sacct_")) == sorted(e["file"] for e in manifest.values())
+            # entries older than max_age_days are removed
+            jobcache.write_cache(cachedir, first, df, max_age_days=-1)
+            assert list(jobcache.load_manifest(cachedir)) == [jobcache.cache_key(first)]
+            assert fname not in os.listdir(cachedir)
+
+    def test_archive(self):
+        ts = lambda d: int(datetime(d.year, d.month, d.day, 12).timestamp())
+        cols = ["jobid", "cluster", "start", "end"]
+        jobs = [["1", "della", str(ts(date(2022, 1, 30))), ts(date(2022, 2, 2))],   # ran into the period
+                ["2", "della", str(ts(date(2022, 2, 10))), ts(date(2022, 2, 11))],
+                ["3", "della", str(ts(date(2022, 3, 10))), ts(date(2022, 5, 2))],   # ended after the period
+                ["4", "della", str(ts(date(2022, 5, 3))), ts(date(2022, 5, 4))],    # started after the period
+                ["5", "della", str(ts(date(2022, 1, 3))), ts(date(2022, 1, 4))]]    # ended before the period
+        with tempfile.TemporaryDirectory() as archive:
+            months = jobcache.append_to_archive(archive, pd.DataFrame(jobs, columns=cols))
+            assert months == ["2022-01", "2022-02", "2022-05"]
+            # re-ingesting a job replaces it
+            jobcache.append_to_archive(archive, pd.DataFrame([jobs[1]], columns=cols))
+            jobcache.write_watermark(archive, datetime(2022, 5, 10, 8, 0, 0))
+            assert jobcache.read_watermark(archive) == datetime(2022, 5, 10, 8, 0, 0)
+            result = jobcache.read_archive(archive, date(2022, 2, 1), date(2022, 4, 30))
+            assert sorted(result.jobid.tolist()) == ["1", "2", "3"]
+            assert list(result.columns) == ["jobid", "cluster", "start"]
+            result = jobcache.read_archive(archive, date(2022, 2, 1), date(2022, 4, 30), columns=["jobid"])
+            assert sorted(result.jobid.tolist()) == ["1", "2", "3"] and list(result.columns) == ["jobid"]
+
+    def test_efficiency_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = effcache.EfficiencyCache(f"{tmpdir}/efficiency.sqlite", max_rows=2)
+            usage = pd.DataFrame([[90, 100, None, None], [50, 100, 10, 40]], columns=effcache.COLUMNS)
+            cache.store(pd.Series(["della", "tiger"]), pd.Series(["1", "2"]), usage)
+            result = cache.lookup(pd.Series(["tiger", "della", "della"], index=[7, 8, 9]), pd.Series(["2", "1", "2"], index=[7, 8, 9]))
+            assert result.index.tolist() == [7, 8, 9]
+            assert result.loc[7].tolist() == [50, 100, 10, 40]
+            assert result.loc[8, "cpu-seconds-used"] == 90 and pd.isna(result.loc[8, "gpu-seconds-used"])
+            assert result.loc[9].isna().all()
+            cache.store(pd.Series(["della"]), pd.Series(["3"]), usage.head(1))
+            cache.conn.execute("UPDATE efficiency SET stored = 0 WHERE jobid = '1'")
+            cache.close()
+            cache = effcache.EfficiencyCache(f"{tmpdir}/efficiency.sqlite")
+            result = cache.lookup(pd.Series(["della", "tiger", "della"]), pd.Series(["1", "2", "3"]))
+            assert result["cpu-seconds-used"].notna().tolist() == [False, True, True]
+            cache.close()
+
+    def test_efficiencies_from_cache(self):
+        # the usage comes from the cache so the jobstats are never decoded
+        df = pd.DataFrame({"jobid":["1", "2", "3", "4", "5"],
+                           "netid":["jdh4", "jdh4", "bill", "bill", "bill"],
+                           "cluster":["tiger", "tiger", "tiger", "della", "della"],
+                           "cluster-partition":["tiger__cpu", "tiger__cpu", "tiger__gpu", "della__cpu", "della__cpu"],
+                           "elapsedraw":[3600, 3600, 3600, 3600, 60],
+                           "admincomment":["JS1:None"] * 5})
+        usage = pd.DataFrame([[10, 100, None, None], [30, 100, None, None], [50, 100, 90, 100], [200, 100, None, None], [1, 1, None, None]],
+                             columns=effcache.COLUMNS)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = effcache.EfficiencyCache(f"{tmpdir}/efficiency.sqlite")
+            cache.store(df.cluster, df.jobid, usage)
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                eff = msr.compute_cpu_and_gpu_efficiencies(df, ["della__cpu", "tiger__cpu", "tiger__gpu"], workers=1, cache=cache)
+            cache.close()
+        assert out.getvalue() == "W: Dropped 1 rows of 1 on della__cpu while computing CPU efficiencies\n"
+        assert eff.values.tolist() == [["jdh4", "20%", "N/A", "tiger__cpu"], ["bill", "50%", "90%", "tiger__gpu"]]
+
+    def test_load_job_shard(self):
+        fields = "jobid,user,cluster,cputimeraw,alloctres"
+        renamings = {"user":"netid", "cputimeraw":"cpu-seconds"}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = f"{tmpdir}/tiger.csv"
+            with open(fname, "w") as f:
+                f.write("jobid,user,cluster,cputimeraw,alloctres,extra\n7,jdh4,tiger2,100,,x\n")
+            rw = msr.load_job_shard(fname, fields, renamings, ["cpu-seconds"])
+            assert list(rw.columns) == ["jobid", "netid", "cluster", "cpu-seconds", "alloctres"]
+            assert rw["cpu-seconds"].dtype == "int64"
+            assert rw.alloctres.tolist() == [""]
+            with open(fname, "w") as f:
+                f.write("jobid,user,cputimeraw\n7,jdh4,100\n")
+            with self.assertRaises(SystemExit):
+                msr.load_job_shard(fname, fields, renamings, ["cpu-seconds"])